@@ -1,14 +1,174 @@
+"""
+Exports every Predicate over remote_api to data/predicates.csv.gz
+
+The keyspace is split into ranges at keys sampled from the __scatter__
+index, and the ranges are pulled in parallel by a pool of threads.  Each
+range is written to its own part file, one gzip member per batch, and the
+cursor and file size reached are checkpointed to a JSON state file after
+every batch.  Run it again with --resume after a dropped connection to
+pick up where every range left off; part files are truncated back to the
+last checkpoint so no row is written twice.  The parts are joined into
+the output file once every range is done.
+"""
 from models import *
 from models.online import *
+from google.appengine.datastore.datastore_query import Cursor
+import argparse
+import gzip
+import json
 import os
+import Queue
+import threading
+import time
 
 dirname = os.path.dirname( os.path.realpath(__file__))
-predicates = ndb.gql("SELECT * FROM Predicate").fetch()
-with open('%s/data/predicates.csv' % (dirname,), 'a') as f:
-    for pred in predicates:
-        arg_and_types = ["%s,%s" % (p[0],p[1]) \
-                    for p in zip(pred.arguments, pred.argument_types)]
-        line = "%i,%s,%s\n" % (pred.frequency, pred.predicate, ','.join(arg_and_types))
-        print line
-        f.write("%s" % line)
 
+
+class Exporter(object):
+
+    def __init__(self, output, state_file, batch_size):
+        self.output = output
+        self.state_file = state_file
+        self.batch_size = batch_size
+        self.parts_dir = output + '.parts'
+        self.state = None
+        self.rows = 0
+        self.lock = threading.Lock()
+
+    def plan(self, n_ranges):
+        """
+        Splits the keyspace into at most `n_ranges` ranges
+        """
+        samples = Predicate.query().order(ndb.GenericProperty('__scatter__')) \
+                .fetch(n_ranges - 1, keys_only=True)
+        bounds = [None] + sorted(samples) + [None]
+        if not os.path.isdir(self.parts_dir):
+            os.makedirs(self.parts_dir)
+        self.state = {'ranges': []}
+        for i, (start, end) in enumerate(zip(bounds, bounds[1:])):
+            part = os.path.join(self.parts_dir, 'part-%04i.csv.gz' % i)
+            open(part, 'wb').close()
+            self.state['ranges'].append({
+                'start': start.urlsafe() if start else None,
+                'end': end.urlsafe() if end else None,
+                'part': part, 'cursor': None, 'size': 0, 'rows': 0,
+                'done': False})
+        self.save()
+
+    def load(self):
+        with open(self.state_file) as f:
+            self.state = json.load(f)
+        for r in self.state['ranges']:
+            # drop whatever was written after the last checkpoint
+            with open(r['part'], 'ab') as f:
+                f.truncate(r['size'])
+
+    def save(self):
+        with self.lock:
+            tmp = self.state_file + '.tmp'
+            with open(tmp, 'w') as f:
+                json.dump(self.state, f, indent=1)
+            os.rename(tmp, self.state_file)
+
+    def query(self, r):
+        query = Predicate.query()
+        if r['start']:
+            query = query.filter(Predicate.key >= ndb.Key(urlsafe=r['start']))
+        if r['end']:
+            query = query.filter(Predicate.key < ndb.Key(urlsafe=r['end']))
+        return query.order(Predicate.key)
+
+    def export_range(self, r):
+        """
+        Pulls one range, checkpointing after every batch
+        """
+        query = self.query(r)
+        cursor = Cursor(urlsafe=r['cursor']) if r['cursor'] else None
+        more = True
+        while more:
+            predicates, cursor, more = query.fetch_page(self.batch_size,
+                    start_cursor=cursor)
+            lines = ''.join(p.to_csv().encode('utf-8') + '\n' for p in predicates)
+            with open(r['part'], 'ab') as f:
+                with gzip.GzipFile(fileobj=f, mode='wb') as gz:
+                    gz.write(lines)
+                size = f.tell()
+            with self.lock:
+                r['size'] = size
+                r['rows'] += len(predicates)
+                r['cursor'] = cursor.urlsafe() if cursor else None
+                r['done'] = not more
+                self.rows += len(predicates)
+            self.save()
+
+    def run(self, n_threads):
+        todo = Queue.Queue()
+        for r in self.state['ranges']:
+            if not r['done']:
+                todo.put(r)
+        errors = []
+
+        def work():
+            while True:
+                try:
+                    r = todo.get_nowait()
+                except Queue.Empty:
+                    return
+                try:
+                    self.export_range(r)
+                except Exception, e:
+                    errors.append(e)
+                    print "range %s failed: %r" % (r['part'], e)
+
+        threads = [threading.Thread(target=work) for _ in range(n_threads)]
+        for t in threads:
+            t.daemon = True
+            t.start()
+        started = time.time()
+        while any(t.is_alive() for t in threads):
+            time.sleep(5)
+            self.report(started)
+        self.report(started)
+        return not errors
+
+    def report(self, started):
+        elapsed = max(time.time() - started, 1e-6)
+        ranges = self.state['ranges']
+        print "%i rows in %.0fs, %.1f rows/s, %i/%i ranges done" % (
+                self.rows, elapsed, self.rows / elapsed,
+                len([r for r in ranges if r['done']]), len(ranges))
+
+    def join(self):
+        """
+        Concatenates the header and the parts into the output file
+        """
+        with open(self.output, 'wb') as out:
+            with gzip.GzipFile(fileobj=out, mode='wb') as gz:
+                gz.write(Predicate.CSV_HEADER + '\n')
+            for r in self.state['ranges']:
+                with open(r['part'], 'rb') as f:
+                    for chunk in iter(lambda: f.read(1 << 20), ''):
+                        out.write(chunk)
+        total = sum(r['rows'] for r in self.state['ranges'])
+        print "%i predicates written to %s" % (total, self.output)
+
+
+parser = argparse.ArgumentParser(description="Export all predicates")
+parser.add_argument('--output', default='%s/data/predicates.csv.gz' % (dirname,))
+parser.add_argument('--ranges', type=int, default=32,
+        help="number of key ranges to split the keyspace into")
+parser.add_argument('--threads', type=int, default=8)
+parser.add_argument('--batch-size', type=int, default=500)
+parser.add_argument('--resume', action='store_true',
+        help="continue the export recorded in the state file")
+args = parser.parse_args()
+
+exporter = Exporter(args.output, args.output + '.state.json', args.batch_size)
+if args.resume:
+    exporter.load()
+else:
+    exporter.plan(args.ranges)
+if exporter.run(args.threads):
+    exporter.join()
+else:
+    print "export incomplete, run again with --resume"
@@ -1,52 +1,165 @@
+"""
+Loads the concepts and question templates in data/ into the datastore
+
+The CSV files are read lazily and written in chunks, with several
+put_multi_async batches in flight at once.  Concepts are keyed by their
+name and question templates by a hash of their question, so loading the
+same rows twice leaves the datastore unchanged.  If a run fails, start it
+again with --resume: the existing data is kept and the load picks up
+where it stopped.
+"""
 from models import *
 from models.offline import *
+import argparse
+import collections
+import itertools
+import os
 
 dirname = os.path.dirname( os.path.realpath(__file__))
-ndb.delete_multi(ndb.gql("SELECT __key__ FROM Game").fetch())
-ndb.delete_multi(ndb.gql("SELECT __key__ FROM Predicate").fetch())
-ndb.delete_multi(ndb.gql("SELECT __key__ FROM Question").fetch())
-ndb.delete_multi(ndb.gql("SELECT __key__ FROM QuestionTemplate").fetch())
-ndb.delete_multi(ndb.gql("SELECT __key__ FROM Concept").fetch())
-ndb.delete_multi(ndb.gql("SELECT __key__ FROM Answer").fetch())
-ndb.delete_multi(ndb.gql("SELECT __key__ FROM Player").fetch())
-# load concepts
-a = ndb.Key('Game', 'singleton')
-
-to_add = list()
-with open('%s/data/concepts.csv' % (dirname,), 'r') as f:
-    f.next()  # skip header
-    for line in f:
-        line = line.replace('"', '').strip()
-        items = line.split(",")
-        concept, concept_types = items[0], items[1:]
-        c = Concept(name=concept, parent=a)
-        c.add_concept_type("concept")
-        for ct in concept_types:
-            c.add_concept_type(ct)
-        to_add.append(c)
-n_concepts = len(to_add)
-print "%i concepts loaded " % (n_concepts)
-
-
-with open('%s/data/question_templates.csv' % (dirname,), 'r') as f:
-    f.next()  # skip header
-    for line in f:
-        question, answer_type = line.strip().split(",")
-        
-        qt = QuestionTemplate(question=question,
-                              answer_type=answer_type,
-                              parent=a)
+
+KINDS = ['Game', 'Predicate', 'Question', 'QuestionTemplate', 'Concept',
+         'Answer', 'RoundScore', 'Player', 'ScoreShard', 'Leaderboard']
+
+
+class Writer(object):
+    """
+    Buffers entities and writes them in chunks, keeping at most
+    `in_flight` batches outstanding
+    """
+
+    def __init__(self, chunk_size, in_flight):
+        self.chunk_size = chunk_size
+        self.in_flight = in_flight
+        self.buffer = []
+        self.batches = collections.deque()
+
+    def put(self, entity):
+        self.buffer.append(entity)
+        if len(self.buffer) >= self.chunk_size:
+            self.flush()
+
+    def flush(self):
+        if self.buffer:
+            self.batches.append(ndb.put_multi_async(self.buffer))
+            self.buffer = []
+        while len(self.batches) > self.in_flight:
+            self._wait()
+
+    def drain(self):
+        self.flush()
+        while self.batches:
+            self._wait()
+
+    def _wait(self):
+        for future in self.batches.popleft():
+            future.get_result()
+
+
+def chunks(iterable, size):
+    iterator = iter(iterable)
+    while True:
+        chunk = list(itertools.islice(iterator, size))
+        if not chunk:
+            return
+        yield chunk
+
+def read_rows(filename, strip_quotes=False):
+    """
+    Yields the split lines of a CSV file in data/, past its header
+    """
+    with open('%s/data/%s' % (dirname, filename), 'r') as f:
+        f.next()  # skip header
+        for line in f:
+            if strip_quotes:
+                line = line.replace('"', '')
+            line = line.strip()
+            if line:
+                yield line.split(",")
+
+def delete_all(kind, chunk_size, in_flight):
+    """
+    Deletes every entity of a kind, a page of keys at a time
+    """
+    query = ndb.Query(kind=kind)
+    batches = collections.deque()
+    deleted = 0
+    cursor, more = None, True
+    while more:
+        keys, cursor, more = query.fetch_page(chunk_size, keys_only=True,
+                start_cursor=cursor)
+        batches.append(ndb.delete_multi_async(keys))
+        deleted += len(keys)
+        while len(batches) > in_flight:
+            for future in batches.popleft():
+                future.get_result()
+    while batches:
+        for future in batches.popleft():
+            future.get_result()
+    print "%i %s deleted" % (deleted, kind)
+
+def load_concepts(writer):
+    seen = set()
+    for rows in chunks(read_rows('concepts.csv', strip_quotes=True), writer.chunk_size):
+        keys = [Concept.key_for(row[0]) for row in rows]
+        if seen.intersection(keys):
+            # a name repeated from an earlier chunk: let its write land
+            # first so the types are merged rather than overwritten
+            writer.drain()
+        # every concept was deleted when the load started, so none of
+        # them has an auto-assigned id
+        concepts = Concept.get_or_create_multi([row[0] for row in rows],
+                                               legacy=False)
+        for c, row in zip(concepts, rows):
+            c.add_concept_type("concept")
+            for ct in row[1:]:
+                c.add_concept_type(ct)
+        # duplicate names resolve to the same concept
+        for c in dict((c.key, c) for c in concepts).values():
+            writer.put(c)
+        seen.update(keys)
+    writer.drain()
+    print "%i concepts loaded " % (len(seen))
+
+def load_question_templates(writer):
+    n_templates = 0
+    for question, answer_type in read_rows('question_templates.csv'):
+        qt = QuestionTemplate(key=QuestionTemplate.key_for(question),
+                              question=question,
+                              answer_type=answer_type)
         argument_types  = qt.extract_arguments()
         predicate_name = "_".join(argument_types + [answer_type]).replace(" ", "")
 
         qt.predicate_name = predicate_name
         qt.argument_types = argument_types  # store arguments
-        to_add.append(qt)
+        writer.put(qt)
+        n_templates += 1
+    writer.drain()
+    print "%i questions loaded " % (n_templates)
 
-print "%i questions loaded " % (len(to_add)-n_concepts)
+
+parser = argparse.ArgumentParser(description="Load the fixtures in data/")
+parser.add_argument('--resume', action='store_true',
+        help="keep the existing data and continue a failed load")
+parser.add_argument('--chunk-size', type=int, default=200)
+parser.add_argument('--in-flight', type=int, default=4,
+        help="number of batches written concurrently")
+args = parser.parse_args()
+
+if not args.resume:
+    for kind in KINDS:
+        delete_all(kind, args.chunk_size, args.in_flight)
+
+writer = Writer(args.chunk_size, args.in_flight)
+load_concepts(writer)
+load_question_templates(writer)
 
 # add user
-u = Player(username='test', password='test')
-to_add.append(u)
-# save to db
-ndb.put_multi(to_add)
+if Player.query(Player.username == 'test').get() is None:
+    Player(username='test', password='test').put()
+
+# recount the concept types, and have the servers' samplers reload them
+registry = ConceptTypeRegistry.rebuild()
+for concept_type in registry.counts:
+    concept_sampler.invalidate(concept_type)
+for kind in ['Concept', 'Predicate']:
+    DataVersion.bump(kind)
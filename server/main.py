@@ -10,6 +10,7 @@ from webapp2_flask import *
 from webapp2_extras import sessions
 from webapp2 import Config
 from google.appengine.ext import ndb, webapp
+from google.appengine.datastore.datastore_query import Cursor
 from google.appengine.api import users, memcache
 from google.appengine.api import channel, mail
 from models import *
@@ -23,8 +24,10 @@ config['webapp2_extras.sessions'] = { 'secret_key': 'chengchangchengchan' }
 config['webapp2_extras.auth'] = { 'user_model': Player}
 
 app= Webapp(debug=True, config=config)
-from threading import Thread, Lock
+EXPORT_BATCH_SIZE = 500
+MAX_EXPORT_ROWS = 20000
 client = memcache.Client()
+engine = GameEngine()
 
 #==============================================================================
 #  Helper functions
@@ -36,43 +39,134 @@ def get_memcache(key, default=None):
     else:
         return default
 
-@ndb.transactional(xg=True)
 def get_current_game():
     """
     Returns the current game or restarts it
     """
-    mutex = Lock()
-    mutex.acquire()
+    return engine.current_game()
+
+def get_int_param(request, name):
+    """
+    Returns an integer request parameter, or None if missing or malformed
+    """
     try:
-        game = ndb.Key('Game','singleton').get()
-        if not game:
-            logging.error("creating game")
-            game = Game(key=ndb.Key('Game', 'singleton'))
-            game.put()
-            game = game.start_new_game()
-        elif game.is_banned:
-            logging.error("game banned, creating new one")
-            game = game.start_new_game()
-        elif (game.duration() > game.GAME_DURATION):
-            logging.error("resetting game")
-            game = game.start_new_game()
-    finally:
-        client.set('current_game', game)
-        mutex.release()
-    return game
+        return int(request.params.get(name, ''))
+    except ValueError:
+        return None
+
+def iter_batches(query, start_cursor=None, limit=None):
+    """
+    Pages through a query with cursors, EXPORT_BATCH_SIZE entities at a
+    time, stopping after `limit` entities.  Yields each batch with the
+    cursor to resume after it, or None after the last one.
+    """
+    fetched = 0
+    cursor, more = start_cursor, True
+    while more and (limit is None or fetched < limit):
+        size = EXPORT_BATCH_SIZE
+        if limit is not None:
+            size = min(size, limit - fetched)
+        entities, cursor, more = query.fetch_page(size, start_cursor=cursor)
+        fetched += len(entities)
+        yield entities, (cursor if more else None)
+
+def render_export(request, query, to_row, content_type,
+        separator=u'', prefix=u'', suffix=u''):
+    """
+    Renders the results of a query one batch at a time
+
+    Each entity is formatted with `to_row`; rows are joined by `separator`
+    and wrapped in `prefix` and `suffix`.  The runtime sends a response only
+    once it is complete, so a response holds at most MAX_EXPORT_ROWS rows,
+    or `limit` if that parameter is lower.  When rows remain, the
+    X-Next-Cursor header holds the cursor to pass back as `cursor` for the
+    next piece.
+    """
+    cursor = request.GET.get('cursor')
+    start_cursor = Cursor(urlsafe=cursor) if cursor else None
+    limit = get_int_param(request, 'limit')
+    if limit is None or not 0 < limit <= MAX_EXPORT_ROWS:
+        limit = MAX_EXPORT_ROWS
+
+    def chunks(batches):
+        yield prefix.encode('utf-8')
+        first = True
+        for entities, _ in batches:
+            if not entities:
+                continue
+            rows = separator.join(to_row(e) for e in entities)
+            if not first:
+                rows = separator + rows
+            first = False
+            yield rows.encode('utf-8')
+        yield suffix.encode('utf-8')
+
+    # fetched before responding, so the cursor can go in a header
+    batches = list(iter_batches(query, start_cursor, limit))
+    response = app.render_stream(chunks(batches), content_type)
+    if batches and batches[-1][1]:
+        response.headers['X-Next-Cursor'] = batches[-1][1].urlsafe()
+    return response
+
+def render_csv_export(request, query, header, to_row):
+    """
+    Renders the results of a query as CSV, see `render_export`.  The header
+    is only sent at the start of the export, not with resumed pieces.
+    """
+    prefix = u'' if request.GET.get('cursor') else header + u'\n'
+    return render_export(request, query, lambda e: to_row(e) + u'\n',
+            'text/csv', prefix=prefix)
+
+def render_json_export(request, query, lines=False):
+    """
+    Renders the results of a query as a JSON array, or as JSON lines (one
+    object per line) if `lines` is set, see `render_export`
+    """
+    to_row = lambda e: simplejson.dumps(e.to_dict())
+    if lines:
+        return render_export(request, query, lambda e: to_row(e) + u'\n',
+                'application/x-ndjson')
+    return render_export(request, query, to_row, 'application/json',
+            separator=u',', prefix=u'[', suffix=u']')
+
+def predicate_query(request):
+    """
+    The predicates to export, most frequent first, optionally filtered on
+    the `predicate` name and a `min_frequency`
+    """
+    query = Predicate.query()
+    name = request.GET.get('predicate')
+    if name:
+        query = query.filter(Predicate.predicate == name)
+    min_frequency = get_int_param(request, 'min_frequency')
+    if min_frequency is not None:
+        query = query.filter(Predicate.frequency >= min_frequency)
+    return query.order(-Predicate.frequency, Predicate.predicate)
 
 def game_to_object(game):
-    timeformat = "%a %b %d %H:%M:%S %Y"
-    game_object = {}
-    game_object['background_color'] =  game.background_color
-    game_object['key'] = game.question.urlsafe()
-    game_object['players'] = [str(p) for p in  game.players]
-    game_object['server_time'] = datetime.datetime.now().strftime(timeformat)
-    game_object['game_start'] = game.started_at.strftime(timeformat)
-    game_object['question'] = cgi.escape(game.question_string.encode('ascii', 'ignore'))
-    #.replace("<b>","").replace("</b>", "\<\\b\>")
+    """
+    The game as sent to the clients, as a JSONFragment.
 
-    return game_object
+    Everything but the server time only changes with the round or its
+    players, so it is encoded once and kept on the game until then.
+    """
+    timeformat = "%a %b %d %H:%M:%S %Y"
+    version = (game.round_id, game.question, len(game.players))
+    cached = getattr(game, '_json_fragment', None)
+    if cached is None or cached[0] != version:
+        game_object = {}
+        game_object['background_color'] =  game.background_color
+        game_object['key'] = game.question.urlsafe()
+        game_object['players'] = [str(p) for p in  game.players]
+        game_object['game_start'] = game.started_at.strftime(timeformat)
+        game_object['question'] = cgi.escape(game.question_string.encode('ascii', 'ignore'))
+        #.replace("<b>","").replace("</b>", "\<\\b\>")
+        # left open for the server time
+        cached = (version, simplejson.dumps(game_object)[:-1])
+        game._json_fragment = cached
+    server_time = datetime.datetime.now().strftime(timeformat)
+    return JSONFragment('%s, "server_time": %s}' %
+            (cached[1], simplejson.dumps(server_time)))
 
 #==============================================================================
 #  Admin methods
@@ -82,10 +176,38 @@ def game_to_object(game):
 def top_players(request):
     """
     Shows the top players
+
+    The first page comes from the materialized leaderboard.  Deeper ranks
+    are paged through with datastore cursors, so every page costs the same.
+
+    The leaderboard ranks by total scores, which include points not yet
+    rolled up into Player.score, while deeper pages can only order by
+    Player.score.  Since Player.score never exceeds a total, deeper pages
+    start at the lowest leaderboard score and leave out the players on
+    the leaderboard, so nobody is repeated or skipped.  Their order is only
+    exact once the pending points are rolled up.
     """
-    players = Player.query().order(-Player.score).fetch()
     data = {}
-    data['players'] = players
+    cursor = request.GET.get('cursor')
+    top = Leaderboard.get_top()
+    if cursor is None:
+        data['players'] = top
+        data['start'] = 0
+        data['next_cursor'] = ''
+        data['more'] = len(data['players']) >= Leaderboard.SIZE
+    else:
+        data['start'] = get_int_param(request, 'start') or len(top)
+        query = Player.query()
+        if top:
+            query = query.filter(Player.score <= top[-1]['score'])
+        query = query.order(-Player.score)
+        players, next_cursor, more = query.fetch_page(Leaderboard.SIZE,
+                start_cursor=Cursor(urlsafe=cursor) if cursor else None)
+        on_top = set(e['username'] for e in top)
+        data['players'] = [p for p in players if p.username not in on_top]
+        data['next_cursor'] = next_cursor.urlsafe() if next_cursor else ''
+        data['more'] = more
+    data['next_start'] = data['start'] + len(data['players'])
     return app.render("top_players.html", request, data)
 
 @app.route("/predicates/")
@@ -94,9 +216,10 @@ def top_predicates(request):
     """
     Shows the top predicates
     """
-    predicates = Predicate.query().order(-Predicate.frequency, Predicate.predicate).fetch()
     data = {}
-    data['predicates'] = predicates
+    # only run if the cached table is stale
+    data['predicates'] = Predicate.query().order(-Predicate.frequency, Predicate.predicate)
+    data['predicates_version'] = DataVersion.get('Predicate')
     return app.render("predicates.html", request, data)
 
 @app.route("/predicates.csv/")
@@ -105,13 +228,8 @@ def top_predicates_csv(request):
     """
     Shows the top predicates in CSV
     """
-    predicates = Predicate.query().order(-Predicate.frequency, Predicate.predicate).fetch()
-    output = [','.join(['COUNT','PREDICATE','ARG1','TYPE1','ARG2','TYPE2','ARG3','TYPE3','...'])]
-    for pred in predicates:
-        arg_and_types = ["%s,%s" % (p[0],p[1]) \
-                                        for p in zip(pred.arguments, pred.argument_types)]
-        output.append("%i,%s,%s" % (pred.frequency, pred.predicate, ','.join(arg_and_types)))
-    return app.render_csv('\n'.join(output))
+    return render_csv_export(request, predicate_query(request),
+            Predicate.CSV_HEADER, Predicate.to_csv)
 
 @app.route("/predicates.json/")
 @app.route("/predicates.json")
@@ -119,11 +237,15 @@ def top_predicates_json(request):
     """
     Shows the top predicates in JSON
     """
-    predicates = Predicate.query().order(-Predicate.frequency, Predicate.predicate).fetch()
-    output = []
-    for pred in predicates:
-        output.append(pred.to_dict())
-    return app.render_json(output)
+    return render_json_export(request, predicate_query(request))
+
+@app.route("/predicates.jsonl/")
+@app.route("/predicates.jsonl")
+def top_predicates_jsonl(request):
+    """
+    Shows the top predicates in JSON lines
+    """
+    return render_json_export(request, predicate_query(request), lines=True)
 
 @app.route("/concepts.csv/")
 @app.route("/concepts.csv")
@@ -131,27 +253,23 @@ def concepts_csv(request):
     """
     Shows the top concepts in CSV
     """
-    concepts = Concept.query().fetch()
-    #concepts = Concept.query().order(Concept.name).fetch()
-    output = [','.join(['NAME','TYPE1','TYPE2','TYPE3','...'])]
-
-    for c in concepts:
-        concept_and_types = [c.name]
-        concept_and_types.extend(c.concept_types)
-        output.append(','.join(concept_and_types))
-    return app.render_csv('\n'.join(output))
+    return render_csv_export(request, Concept.query(), Concept.CSV_HEADER, Concept.to_csv)
 
 @app.route("/concepts.json/")
 @app.route("/concepts.json")
 def concepts_json(request):
     """
-    Shows 
+    Shows the concepts in JSON
     """
-    concepts = Concept.query().fetch()
-    output = []
-    for c in concepts:
-        output.append(c.to_dict())
-    return app.render_json(output)
+    return render_json_export(request, Concept.query())
+
+@app.route("/concepts.jsonl/")
+@app.route("/concepts.jsonl")
+def concepts_jsonl(request):
+    """
+    Shows the concepts in JSON lines
+    """
+    return render_json_export(request, Concept.query(), lines=True)
 
 @app.route("/game/")
 @app.route("/game")
@@ -162,6 +280,7 @@ def admin_list_games(request):
     data = {}
     data['games'] = Game.query().fetch()
     data['current_game'] = get_current_game()
+    data['engine_stats'] = engine.stats
     return app.render("admin_list_games.html", request, data)
 
 @app.route("/game/create", admin=True)
@@ -185,7 +304,11 @@ def delete_by_key(request):
         if key == "entry":
             keys_to_delete.append(ndb.Key(urlsafe=val))
     app.add_message("%i elements deleted " % (len(keys_to_delete)))
+    concepts = ndb.get_multi([k for k in keys_to_delete if k.kind() == 'Concept'])
     ndb.delete_multi(keys_to_delete)
+    Concept.unindex([c for c in concepts if c is not None])
+    for kind in set(k.kind() for k in keys_to_delete):
+        DataVersion.bump(kind)
     return app.redirect(request.POST['return'])
 
 
@@ -197,7 +320,9 @@ def admin_concepts(request):
     """
     data = {}
     data['concept_types'] = Concept.get_concept_types()
-    data['concepts'] = Concept.query().fetch()
+    # only run if the cached table is stale
+    data['concepts'] = Concept.query()
+    data['concepts_version'] = DataVersion.get('Concept')
     data['question_templates'] = QuestionTemplate.query().fetch()
     return app.render("admin_concepts.html", request, data)
 
@@ -211,6 +336,8 @@ def add_concept_type(request, concept_key):
     if concept:
         concept.add_concept_type(request.POST['concept_type'])
         concept.put()
+        Concept.index_new_types([concept])
+        DataVersion.bump('Concept')
         return "OK"
     else:
         return "Concept Not Found"
@@ -232,6 +359,8 @@ def add_concept(request):
             if key == "concept_types":
                 new_concept.add_concept_type(val)
         new_concept.put()
+        Concept.index_new_types([new_concept])
+        DataVersion.bump('Concept')
 
     return app.redirect("/concept")
 
@@ -289,6 +418,7 @@ def add_question_template(request):
 
     else:
         key = qt.put()
+        template_sampler.invalidate()
         app.add_message("Question %s added!" % key)
 
     return app.redirect("/question-template")
@@ -296,15 +426,15 @@ def add_question_template(request):
 #==============================================================================
 #  Game Methods
 #==============================================================================
-@app.route("/flexserver/process_answer")
-@app.route("/flexserver/process_answer/")
+@app.route("/flexserver/process_answer", sessions=False)
+@app.route("/flexserver/process_answer/", sessions=False)
 def add_new_answer(request):
     """
     Adds a users' answer to the game
     
     Ancestor path:  game -> user -> answer
     """
-    answer = request.POST['answer'].strip().lower()
+    answer = normalize_answer(request.POST['answer'])
     user_key = ndb.Key(urlsafe=request.POST['user_key'])
     player_name = request.POST['username']
     current_game = get_current_game()
@@ -316,18 +446,21 @@ def add_new_answer(request):
         return app.render_json({'user': {'username': player_name,
                                          'key': 'undefined'},
                                 'game': game_to_object(get_current_game())})
-    current_game.add_answer(player_name=player_name, player_key=user_key, answer=answer)
+    if answer:
+        round_id = current_game.round_id
+        Answer.store(round_id, player_name, user_key, answer)
+        engine.update(lambda game: game.add_answer(round_id, player_name,
+                                                   user_key, answer))
 
-    is_updated, data = current_game.status(player_name)
-    if is_updated:
-        current_game.put()
+    since = get_int_param(request, 'status_version')
+    current_game, data = engine.player_status(player_name, since=since)
 
     data.update({'game': game_to_object(current_game)})
     return app.render_json(data)
 
 
-@app.route("/flexserver/flagquestion")
-@app.route("/flexserver/flagquestion/")
+@app.route("/flexserver/flagquestion", sessions=False)
+@app.route("/flexserver/flagquestion/", sessions=False)
 def flag_question(request):
     """
     The request method when a player flags a question as 'nonsensical'
@@ -340,17 +473,18 @@ def flag_question(request):
     if not question_key:
         logging.error("No Game Key in Request"+str(request.POST))
         return app.redirect("/flexserver/checkup")
-    game = get_current_game()
     problem_type = int(request.POST['problem_type'])
-    if game.flag(problem_type):  # flag game
-        # changed
-        game.put()
+    banned = engine.update(lambda game: game.flag(problem_type))
+    if banned is not None:
+        question = banned.get()
+        question.is_banned = True
+        question.put()
 
     return app.redirect("/flexserver/checkup")
 
 
-@app.route("/flexserver/finalscore")
-@app.route("/flexserver/finalscore/")
+@app.route("/flexserver/finalscore", sessions=False)
+@app.route("/flexserver/finalscore/", sessions=False)
 def compute_final_score(request):
     """
     Returns the resulting score for all players
@@ -368,26 +502,25 @@ def compute_final_score(request):
                                 'game': game_to_object(current_game)})
 
 
-    is_updated, data = current_game.status(player_name, True)
-    if is_updated:
-        current_game.put()
+    since = get_int_param(request, 'status_version')
+    current_game, data = engine.player_status(player_name, True, since)
     data.update({'game': game_to_object(current_game)})
     return app.render_json(data)
 
 
-@app.route("/flexserver/checkup")
-@app.route("/flexserver/checkup/")
+@app.route("/flexserver/checkup", sessions=False)
+@app.route("/flexserver/checkup/", sessions=False)
 def checkup_game_status(request):
     """
     Flash clients call this function every 3 seconds 
     
-    This returns details of the game back 
+    This returns details of the game back.  Clients that send the
+    `status_version` they last saw only get what changed since.
     """
 
     question_key = ndb.Key(urlsafe=request.POST['game_key'])
     player_name = request.POST['username']
     game = get_current_game()
-    game.add_player(player_name)
 
     # TODO: check mismatching game keys
     if game.question!= question_key:
@@ -397,14 +530,30 @@ def checkup_game_status(request):
                                          'key': 'undefined'},
                                 'game': game_to_object(game)})
 
-    is_updated, data = game.status(player_name)
-    if is_updated:
-        game.put()
+    since = get_int_param(request, 'status_version')
+    game, data = engine.player_status(player_name, since=since)
     data.update({'game': game_to_object(game)})
     return app.render_json(data)
 
 
-@app.route("/flexserver/users/", methods=["POST"])
+@app.route("/flexserver/wait", sessions=False)
+@app.route("/flexserver/wait/", sessions=False)
+def wait_game_status(request):
+    """
+    Long-poll variant of checkup
+
+    Holds the request until the status changes after the `status_version`
+    the client last saw, the round moves on to scoring, or the wait times
+    out, and then answers exactly like checkup.  Clients that have no
+    version yet get an immediate answer.
+    """
+    since = get_int_param(request, 'status_version')
+    if since is not None:
+        engine.wait_for_change(since)
+    return checkup_game_status(request)
+
+
+@app.route("/flexserver/users/", methods=["POST"], sessions=False)
 def create_user_account(request):
     """
     Create the user's account
@@ -424,8 +573,8 @@ def create_user_account(request):
         return app.render_json({'error': "User name already exists"})
 
 
-@app.route("/flexserver/login")
-@app.route("/flexserver/login/")
+@app.route("/flexserver/login", sessions=False)
+@app.route("/flexserver/login/", sessions=False)
 def login_route(request):
     """
     Takes login request and responds with a JSON object
@@ -445,6 +594,18 @@ def login_route(request):
     else:
         return app.render_json({"error": "No player with username '%s' could be found." % (username)})
 
+#==============================================================================
+#  Tasks, restricted to admins and cron in app.yaml
+#==============================================================================
+@app.route("/tasks/rollup_scores")
+def rollup_scores(request):
+    """
+    Folds the sharded score counters into Player.score
+    """
+    updated = ScoreShard.rollup()
+    logging.info("%i player scores rolled up" % (updated))
+    return "%i players updated" % (updated)
+
 #==============================================================================
 #  Main UI Routes 
 #==============================================================================
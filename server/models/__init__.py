@@ -4,4 +4,5 @@
 from concept import *
 from player import *
 from game import *
-from question import *
\ No newline at end of file
+from question import *
+from engine import *
\ No newline at end of file
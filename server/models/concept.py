@@ -2,7 +2,11 @@ from google.appengine.ext import ndb
 from google.appengine.api import memcache
 import logging
 import datetime
+import hashlib
+import json
 import random
+import time
+import uuid
 from collections import defaultdict
 
 class GameCreationException(Exception):
@@ -11,6 +15,173 @@ class GameCreationException(Exception):
     """
     pass
 
+class DataVersion(object):
+    """
+    A version number per kind, kept in memcache and bumped whenever
+    entities of that kind are written, so pages rendered from them can be
+    cached until the data changes
+    """
+    KEY = 'data_version:%s'
+
+    @classmethod
+    def get(cls, kind):
+        version = memcache.get(cls.KEY % kind)
+        if version is None:
+            # start past any version used before memcache lost the counter
+            memcache.add(cls.KEY % kind, int(time.time()))
+            version = memcache.get(cls.KEY % kind)
+        return version
+
+    @classmethod
+    def bump(cls, kind):
+        memcache.incr(cls.KEY % kind, initial_value=int(time.time()))
+
+class ConceptSampler(object):
+    """
+    Keeps the keys of the members of each concept type in memory, so a
+    random member can be drawn in constant time.
+
+    Each type's membership has a version token in memcache.  Writers that
+    change the membership update their own list in place and store a new
+    token; other instances see the token change and reload that type's
+    keys with one keys-only query.
+    """
+    VERSION_KEY = 'concept_type_version:%s'
+
+    def __init__(self):
+        self.members = {}   # concept type -> list of concept keys
+        self.versions = {}  # concept type -> version token of the list
+
+    def sample(self, concept_type):
+        """
+        Returns the key of a random concept of this type, or None
+        """
+        version = memcache.get(self.VERSION_KEY % concept_type)
+        if version is None or version != self.versions.get(concept_type):
+            self._load(concept_type, version)
+        members = self.members[concept_type]
+        if not members:
+            return None
+        return random.choice(members)
+
+    def add(self, concept_type, keys):
+        """
+        Records new members of a concept type
+        """
+        members = self.members.get(concept_type)
+        if members is not None:
+            known = set(members)
+            members.extend(k for k in keys if k not in known)
+        self._bump(concept_type)
+
+    def invalidate(self, concept_type):
+        """
+        Forces every instance to reload the members of a concept type
+        """
+        self.members.pop(concept_type, None)
+        self.versions.pop(concept_type, None)
+        memcache.delete(self.VERSION_KEY % concept_type)
+
+    def _load(self, concept_type, version):
+        if version is None:
+            version = uuid.uuid4().hex
+            if not memcache.add(self.VERSION_KEY % concept_type, version):
+                version = memcache.get(self.VERSION_KEY % concept_type)
+        self.members[concept_type] = Concept.query(
+                Concept.concept_types==concept_type,
+                ancestor=ndb.Key('Game', 'singleton')).fetch(keys_only=True)
+        self.versions[concept_type] = version
+
+    def _bump(self, concept_type):
+        version = uuid.uuid4().hex
+        memcache.set(self.VERSION_KEY % concept_type, version)
+        if concept_type in self.members:
+            self.versions[concept_type] = version
+
+
+class ConceptTypeRegistry(ndb.Model):
+    """
+    Every concept type in use, with its number of members.
+
+    The registry is updated as concepts are saved or deleted, so listing
+    and validating concept types is a single key lookup, cached in memory
+    for CACHE_SECONDS, instead of a scan over every concept.
+    """
+    CACHE_SECONDS = 30
+
+    counts = ndb.PickleProperty()  # concept type -> number of members
+
+    _cached_counts = None
+    _cached_at = 0
+
+    @classmethod
+    def registry_key(cls):
+        return ndb.Key(cls, 'registry')
+
+    @classmethod
+    def get_counts(cls):
+        """
+        Returns the number of members of each concept type
+        """
+        if cls._cached_counts is None or \
+                time.time() - cls._cached_at > cls.CACHE_SECONDS:
+            registry = cls.registry_key().get()
+            if registry is None:
+                registry = cls.rebuild()
+            cls._remember(registry)
+        return cls._cached_counts
+
+    @classmethod
+    def update(cls, deltas):
+        """
+        Adds a concept type -> change in members mapping to the registry,
+        once the concepts have been saved or deleted
+        """
+        if not deltas:
+            return
+        if cls.registry_key().get() is None:
+            # deltas are applied after saving, so a recount includes them
+            cls.rebuild()
+        else:
+            cls._remember(cls._apply(deltas))
+
+    @classmethod
+    def rebuild(cls):
+        """
+        Recounts the members of every concept type from scratch
+        """
+        counts = defaultdict(int)
+        # projecting a repeated property yields one result per value
+        for concept in ndb.gql("SELECT concept_types FROM Concept").fetch():
+            for ct in concept.concept_types:
+                counts[ct] += 1
+        registry = cls(key=cls.registry_key(), counts=dict(counts))
+        registry.put()
+        cls._remember(registry)
+        return registry
+
+    @classmethod
+    @ndb.transactional
+    def _apply(cls, deltas):
+        registry = cls.registry_key().get() or \
+                cls(key=cls.registry_key(), counts={})
+        counts = registry.counts or {}
+        for concept_type, delta in deltas.items():
+            count = counts.get(concept_type, 0) + delta
+            if count > 0:
+                counts[concept_type] = count
+            else:
+                counts.pop(concept_type, None)
+        registry.counts = counts
+        registry.put()
+        return registry
+
+    @classmethod
+    def _remember(cls, registry):
+        cls._cached_counts = dict(registry.counts or {})
+        cls._cached_at = time.time()
+
+
 class Concept(ndb.Model):
     """
     A word/phrase representative of a concept
@@ -19,49 +190,155 @@ class Concept(ndb.Model):
     concept_types = ndb.StringProperty(repeated=True)
     created_at = ndb.DateTimeProperty(auto_now_add=True)
 
+    LEGACY_CHECK_SECONDS = 600
+    LEGACY_BATCH_SIZE = 30  # names per IN query
+    _has_legacy = None
+    _legacy_checked_at = 0
+
     @classmethod
     def get_concept_types(cls):
         """
-        Returns all of the concept tags
+        Returns all of the concept tags, mapped to their number of members
         """
-        concept_types = set()
-        for concept in ndb.gql("SELECT concept_types FROM Concept").fetch():
-            for ct in concept.concept_types:
-                concept_types.add(ct)
-        return concept_types
+        return ConceptTypeRegistry.get_counts()
+
+    @classmethod
+    def key_for(cls, name):
+        """
+        Concepts are keyed by their normalized name
+        """
+        name = ' '.join(name.lower().split())
+        return ndb.Key(cls, name, parent=ndb.Key('Game', 'singleton'))
 
     @classmethod
     def get_or_create(cls, name):
         """
+        Returns the concept with this name, or a new unsaved one
         """
-        a = ndb.Key('Game', 'singleton')
-        concept = cls.query(cls.name==name, ancestor=a).get()
-        if not concept:
-            concept = Concept(name=name, parent=a)
-        return concept
+        return cls.get_or_create_multi([name])[0]
+
+    @classmethod
+    def get_or_create_multi(cls, names, legacy=None):
+        """
+        Returns the concepts with these names, in order, fetched with a
+        single get_multi.  Concepts that are missing are created but not
+        saved.
+
+        While concepts saved before they were keyed by name are left, which
+        have auto-assigned ids, the names it misses are looked up among
+        them too, so no second copy of those is created.  Pass `legacy` to
+        skip the check for them, such as when they were all deleted.
+        """
+        keys = [cls.key_for(name) for name in names]
+        by_key = dict((key, concept) for key, concept in
+                zip(keys, ndb.get_multi(keys)) if concept is not None)
+        aliases = {}  # missing key -> the names it was asked for by
+        for key, name in zip(keys, names):
+            if key not in by_key:
+                aliases.setdefault(key, set([key.id()])).add(name)
+        if legacy is None:
+            legacy = aliases and cls.has_legacy()
+        found = cls._find_legacy(aliases) if legacy else {}
+        for key, asked in aliases.items():
+            matches = [found[name] for name in sorted(asked) if name in found]
+            by_key[key] = matches[0] if matches else cls(key=key, name=key.id())
+        return [by_key[key] for key in keys]
+
+    @classmethod
+    def has_legacy(cls):
+        """
+        True while some concepts still have auto-assigned ids.  Ids sort
+        before names, so the first key tells; it is checked once every
+        LEGACY_CHECK_SECONDS.
+        """
+        if cls._has_legacy is None or \
+                time.time() - cls._legacy_checked_at > cls.LEGACY_CHECK_SECONDS:
+            first = cls.query(ancestor=ndb.Key('Game', 'singleton')) \
+                    .order(cls.key).get(keys_only=True)
+            cls._has_legacy = first is not None and \
+                    not isinstance(first.id(), basestring)
+            cls._legacy_checked_at = time.time()
+        return cls._has_legacy
+
+    @classmethod
+    def _find_legacy(cls, aliases):
+        """
+        Maps the names asked for to the concepts with auto-assigned ids that
+        have them, with one IN query per LEGACY_BATCH_SIZE names
+        """
+        asked = sorted(set().union(*aliases.values()))
+        futures = [cls.query(cls.name.IN(asked[i:i + cls.LEGACY_BATCH_SIZE]),
+                ancestor=ndb.Key('Game', 'singleton')).fetch_async()
+                for i in range(0, len(asked), cls.LEGACY_BATCH_SIZE)]
+        found = {}
+        for future in futures:
+            for concept in future.get_result():
+                found.setdefault(concept.name, concept)
+        return found
 
     @classmethod
     def get_random(cls, concept_type):
         """
         Returns a random concept of a particular type
         """
-        a = ndb.Key('Game', 'singleton')
-        concepts = cls.query(cls.concept_types==concept_type, \
-                ancestor=a).fetch()
-        if len(concepts) == 0:
+        key = concept_sampler.sample(concept_type)
+        if key is None:
             msg = "ConceptType %s has no members" % (concept_type)
             logging.error(msg)
             raise GameCreationException(msg)
-        return concepts[random.randint(0, len(concepts)-1)]
+        concept = key.get()
+        if concept is None or concept_type not in concept.concept_types:
+            # deleted or changed behind the sampler's back
+            concept_sampler.invalidate(concept_type)
+            raise GameCreationException("Stale member of %s" % (concept_type))
+        return concept
 
+    @classmethod
+    def index_new_types(cls, concepts):
+        """
+        Adds saved concepts to the sampling index and the registry of the
+        concept types they joined since they were loaded
+        """
+        joined = defaultdict(list)
+        for concept in concepts:
+            for concept_type in getattr(concept, '_new_types', ()):
+                joined[concept_type].append(concept.key)
+            concept._new_types = set()
+        for concept_type, keys in joined.items():
+            concept_sampler.add(concept_type, keys)
+        ConceptTypeRegistry.update(dict((concept_type, len(keys))
+                for concept_type, keys in joined.items()))
+
+    @classmethod
+    def unindex(cls, concepts):
+        """
+        Removes deleted concepts from the registry of their concept types
+        """
+        left = defaultdict(int)
+        for concept in concepts:
+            for concept_type in concept.concept_types:
+                left[concept_type] -= 1
+        ConceptTypeRegistry.update(dict(left))
 
     def add_concept_type(self, concept_type):
         """
-        Adds a concept type
+        Adds a concept type.  Call Concept.index_new_types once the concept
+        is saved.
         """
         cleaned = concept_type.strip().lower()
         if cleaned not in self.concept_types:
             self.concept_types.append(cleaned)
+            if not hasattr(self, '_new_types'):
+                self._new_types = set()
+            self._new_types.add(cleaned)
+
+    CSV_HEADER = ','.join(['NAME','TYPE1','TYPE2','TYPE3','...'])
+
+    def to_csv(self):
+        """
+        Returns the Concept Name and its types as a CSV line
+        """
+        return ','.join([self.name] + self.concept_types)
 
     def to_dict(self):
         """
@@ -85,26 +362,60 @@ class Predicate(ndb.Model):
     frequency = ndb.IntegerProperty(default=0)
     question_keys = ndb.KeyProperty(repeated=True)
 
+    @classmethod
+    def key_for(cls, predicate, arguments, argument_types):
+        """
+        Key named after a hash of the canonical form of the predicate, so
+        the same assertion always maps to the same entity
+        """
+        canonical = json.dumps([predicate, list(arguments), list(argument_types)])
+        return ndb.Key(cls, hashlib.sha1(canonical).hexdigest())
+
     @classmethod
     def update_or_create(cls, predicate, arguments, argument_types, question_key, frequency=1):
         """
         Gets the predicate or adds to the existing one
         """
-        p = ndb.gql("""SELECT * FROM Predicate
-                         WHERE predicate = :1
-                         AND argument_types IN :2
-                         AND arguments IN :3""", predicate, argument_types, arguments).get()
-        if not p:
-            p = cls(predicate=predicate,
-                    arguments=arguments,
-                    argument_types=argument_types)
+        return cls.update_or_create_multi(
+                [(predicate, arguments, argument_types, frequency)],
+                question_key)[0]
+
+    @classmethod
+    def update_or_create_multi(cls, assertions, question_key):
+        """
+        Adds the (predicate, arguments, argument_types, frequency) tuples
+        found by a question to their predicates, fetched with a single
+        get_multi.  Returns the predicates, to be saved with one put_multi.
+        """
+        keys = [cls.key_for(*assertion[:3]) for assertion in assertions]
+        by_key = {}
+        for key, p in zip(keys, ndb.get_multi(keys)):
+            if p is not None:
+                by_key[key] = p
 
-        # add question key
-        if question_key not in p.question_keys:
-            p.question_keys.append(question_key)
+        for key, (predicate, arguments, argument_types, frequency) in \
+                zip(keys, assertions):
+            p = by_key.get(key)
+            if p is None:
+                p = by_key[key] = cls(key=key,
+                                      predicate=predicate,
+                                      arguments=arguments,
+                                      argument_types=argument_types)
+            # add question key
+            if question_key not in p.question_keys:
+                p.question_keys.append(question_key)
+            p.frequency += frequency
+        return by_key.values()
 
-        p.frequency += frequency
-        return p
+    CSV_HEADER = ','.join(['COUNT','PREDICATE','ARG1','TYPE1','ARG2','TYPE2','ARG3','TYPE3','...'])
+
+    def to_csv(self):
+        """
+        Returns the predicate as a CSV line
+        """
+        arg_and_types = ["%s,%s" % (p[0],p[1]) \
+                for p in zip(self.arguments, self.argument_types)]
+        return "%i,%s,%s" % (self.frequency, self.predicate, ','.join(arg_and_types))
 
     def to_dict(self):
         """
@@ -123,3 +434,6 @@ class Predicate(ndb.Model):
         arg_types = ["%s:%s" % (p[0],p[1]) \
                 for p in zip(self.arguments, self.argument_types)]
         return "%s(%s)" % (self.predicate, ', '.join(arg_types))
+
+
+concept_sampler = ConceptSampler()
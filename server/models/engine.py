@@ -0,0 +1,364 @@
+from google.appengine.ext import ndb
+from google.appengine.api import memcache
+import datetime
+import logging
+import threading
+import time
+import uuid
+
+from .game import Game, RoundScore
+from .question import template_sampler, question_pool
+
+
+class GameEngine(object):
+    """
+    Keeps the live round in memory on this instance.
+
+    Instances share the game through memcache, where it is stored along
+    with a version token.  An instance publishes its changes with a
+    compare-and-set against the version it started from, so a change made
+    on a stale copy is redone on the newer one instead of overwriting it.
+    The latest version is also kept under its own key, which is cheap to
+    compare on every request, so the game is only reloaded when it changed.
+    The datastore is only touched on round transitions, on periodic
+    checkpoints and when the game was evicted from memcache, so all the
+    writes made to the game in between are coalesced into one.
+
+    The game held by the engine is never changed in place: update() makes
+    its changes on a copy, publishes it and then swaps it in.  `lock` only
+    guards swapping the game and its version, and is never held across an
+    RPC, so requests read the game without waiting.
+    """
+    VERSION_KEY = 'game_version'
+    GAME_KEY = 'current_game'
+    CHECKPOINT_INTERVAL = 10  # seconds
+    WAIT_TIMEOUT = 25  # seconds, well under the request deadline
+    POLL_INTERVAL = 0.5  # seconds
+    SCORING_TIMEOUT = 10  # seconds to wait for scores computed elsewhere
+    MAX_RETRIES = 5  # attempts to publish a change
+    SYNC_INTERVAL = 0.1  # seconds a sync is good for, about one request
+
+    def __init__(self, checkpoint_interval=CHECKPOINT_INTERVAL):
+        self.game = None
+        self.version = None
+        self.checkpoint_interval = checkpoint_interval
+        self.checkpointed_at = None
+        self.synced_at = 0
+        self.unstored_writes = 0
+        self.stats = {'requested': 0, 'stored': 0, 'coalesced': 0}
+        self.lock = threading.Lock()
+        self.rollover_lock = threading.Lock()
+        self.scoring = None  # round_id being scored by a request here
+
+    def current_game(self):
+        """
+        Returns the live game, starting a new round when this one is over
+        """
+        self._sync()
+        game = self.game
+        if game is None or game.is_finished():
+            self._start_round()
+            game = self.game
+        return game
+
+    def update(self, change):
+        """
+        Applies `change` to a copy of the live game, then publishes the copy
+        and swaps it in if it changed.
+
+        `change` must only change the game in memory, marking it dirty if it
+        did.  If another instance published first, `change` is applied
+        again to its game.  Returns what `change` returned.
+        """
+        for attempt in range(self.MAX_RETRIES):
+            self.current_game()
+            with self.lock:
+                base, version = self.game, self.version
+            game = self._copy(base)
+            rv = change(game)
+            pending = game.pending_writes()
+            if not pending:
+                return rv
+            game._pending_writes = 0
+            token = self._publish(game, version)
+            snapshot = None
+            with self.lock:
+                if token is not None and self.version == version:
+                    self.game, self.version = game, token
+                    self.unstored_writes += pending
+                    self.stats['requested'] += pending
+                    if self._checkpoint_due():
+                        snapshot = self._checkpoint()
+                elif self.version == version:
+                    # drop the stale game at the next sync
+                    self.version = None
+            if snapshot is not None:
+                self._store(snapshot)
+            if token is not None:
+                return rv
+            logging.info("game changed by another instance, retrying")
+        logging.error("change not published after %i attempts" % (self.MAX_RETRIES))
+        return rv
+
+    def player_status(self, player_name, force_answer=False, since=None):
+        """
+        Adds the player to the live game and returns the game along with the
+        player's status, scoring the round first if that is due
+        """
+        if player_name not in self.current_game().players:
+            self.update(lambda game: game.add_player(player_name))
+        if self.game.needs_scoring(force_answer):
+            self.score_round()
+        game = self.game
+        status = game.status(player_name, force_answer, since)
+        if 'total_score' in status and status['total_score'] is None:
+            # the player did not answer this round
+            status['total_score'] = Game.total_score_of(player_name)
+        return game, status
+
+    def score_round(self):
+        """
+        Scores the answer round of the live game.
+
+        The request that claims the round's RoundScore computes the scores;
+        every other one, here or on other instances, waits for them.
+        """
+        game = self.game
+        round_id = game.round_id
+        with self.lock:
+            scoring_here = self.scoring == round_id
+            if not scoring_here:
+                self.scoring = round_id
+        scores = None
+        if not scoring_here:
+            if RoundScore.claim(round_id):
+                try:
+                    scores = Game.score(*game.scoring_snapshot())
+                except Exception:
+                    # let a later request claim it once the claim expires
+                    with self.lock:
+                        self.scoring = None
+                    raise
+                RoundScore.finish(round_id, scores)
+            else:
+                with self.lock:
+                    self.scoring = None
+        if scores is None:
+            scores = self._wait_for_scores(round_id)
+        if scores is not None:
+            self.update(lambda game: game.set_scores(round_id, scores))
+
+    def wait_for_change(self, status_version, timeout=None):
+        """
+        Blocks until the game's status_version differs from `status_version`,
+        the round moves on to its answer phase, or `timeout` seconds have
+        passed.
+
+        Waiting requests on this instance share one memcache lookup per
+        POLL_INTERVAL.  Returns True iff something changed.
+        """
+        deadline = time.time() + (timeout or self.WAIT_TIMEOUT)
+        is_answer_round = self.current_game().is_answer_round()
+        while True:
+            game = self.game
+            if game.status_version != status_version:
+                return True
+            if game.is_answer_round() != is_answer_round or \
+                    game.is_finished():
+                return True
+            remaining = deadline - time.time()
+            if remaining <= 0:
+                return False
+            time.sleep(min(self.POLL_INTERVAL, remaining))
+            if time.time() - self.synced_at >= self.POLL_INTERVAL:
+                self.current_game()
+
+    def _wait_for_scores(self, round_id):
+        """
+        Waits for the scores of a round computed by another request.  Returns
+        them if they did not reach this instance with the game, else None.
+        """
+        deadline = time.time() + self.SCORING_TIMEOUT
+        while time.time() < deadline:
+            time.sleep(self.POLL_INTERVAL)
+            game = self.current_game()
+            if game.round_id != round_id or not game.needs_scoring(True):
+                return None
+        return RoundScore.scores_of(round_id)
+
+    def _checkpoint(self):
+        """
+        Returns a copy of the live game to store, so the put can be made
+        outside of the lock
+        """
+        self.stats['stored'] += 1
+        if self.unstored_writes > 1:
+            self.stats['coalesced'] += self.unstored_writes - 1
+            logging.info("game stored, %i writes coalesced" %
+                    (self.unstored_writes - 1))
+        self.unstored_writes = 0
+        self.checkpointed_at = datetime.datetime.now()
+        return self._copy(self.game)
+
+    @staticmethod
+    def _copy(game):
+        return Game._from_pb(game._to_pb())
+
+    @staticmethod
+    @ndb.transactional
+    def _store(game):
+        """
+        Stores a checkpoint of the game, unless a later state was stored
+        since, such as the next round started by another instance
+        """
+        stored = game.key.get()
+        # round ids are timestamps, so they sort in order
+        if stored is not None and (stored.round_id > game.round_id or
+                (stored.round_id == game.round_id and
+                 stored.status_version > game.status_version)):
+            logging.info("checkpoint of round %s skipped" % (game.round_id))
+            return
+        game.put()
+
+    def _swap(self, game, version):
+        with self.lock:
+            self.game, self.version = game, version
+
+    def _sync(self):
+        """
+        Reloads the game if another instance has published a newer version.
+
+        The calls made while handling one request share a single lookup: the
+        game is not checked again within SYNC_INTERVAL of the last check,
+        unless its version was dropped after a failed publish.
+        """
+        with self.lock:
+            current, known = self.game, self.version
+        now = time.time()
+        if current is not None and known is not None and \
+                now - self.synced_at < self.SYNC_INTERVAL:
+            return
+        self.synced_at = now
+        version = memcache.get(self.VERSION_KEY)
+        if current is not None and known is not None and version == known:
+            return
+        cached = memcache.get(self.GAME_KEY)
+        if cached is not None:
+            # the version key can lag behind or be evicted on its own: the
+            # game is what counts
+            if cached[0] != known or current is None:
+                self._swap(cached[1], cached[0])
+            if version is None:
+                memcache.add(self.VERSION_KEY, cached[0])
+            return
+        # memcache was flushed or evicted: fall back to the datastore
+        game = Game.singleton_key().get()
+        if game is None:
+            logging.error("creating game")
+            self._swap(None, None)
+            return
+        # rebuild the tallies now rather than on first use
+        game._get_tallies()
+        # the checkpoint can be older than what clients have seen
+        game.bump_status_version()
+        token = self._publish(game, None)
+        if token is None:
+            # another instance restored it first
+            cached = memcache.get(self.GAME_KEY)
+            if cached is not None:
+                self._swap(cached[1], cached[0])
+            return
+        self._swap(game, token)
+
+    def _start_round(self):
+        """
+        Rolls the live game over to a new round and publishes it.  The
+        other requests of this instance wait for the one doing it.
+        """
+        with self.rollover_lock:
+            self._sync()
+            live = self.game
+            if live is not None and not live.is_finished():
+                # started while this request waited
+                return
+            question = Game.generate_question(live.question if live else None)
+            game = self._rollover(live, question.key)
+            if game.question == question.key:
+                template_sampler.record_use(question.question_template.get())
+            else:
+                # another instance started the round: keep the question for
+                # a later one
+                question_pool.push([question.key])
+            self._sync()
+            with self.lock:
+                current, version = self.game, self.version
+            if current is not None and current.round_id == game.round_id:
+                # another instance published it first
+                return
+            token = self._publish(game, version)
+            with self.lock:
+                if token is None or self.version != version:
+                    # take whatever was published instead at the next sync
+                    self.version = None
+                    return
+                self.game, self.version = game, token
+                self.unstored_writes = 0
+                self.checkpointed_at = datetime.datetime.now()
+
+    @staticmethod
+    @ndb.transactional(xg=True)
+    def _rollover(live, question_key):
+        """
+        Starts a new round of the live game on `question_key`, unless
+        another instance already has.  The round being closed is not stored:
+        its answers and scores are kept in their own entities.
+        """
+        stored = Game.singleton_key().get()
+        if not stored:
+            game = Game(key=Game.singleton_key())
+            game.put()
+            return game.start_new_game(question_key)
+        if live is None or live.round_id != stored.round_id:
+            # the next round was started elsewhere
+            game = stored
+        else:
+            # a copy, as the live game is shared and the transaction can
+            # be retried
+            game = GameEngine._copy(live)
+            game.status_version = max(live.status_version, stored.status_version)
+        if game.is_banned:
+            logging.error("game banned, creating new one")
+            game = game.start_new_game(question_key)
+        elif game.duration() > Game.GAME_DURATION:
+            logging.error("resetting game")
+            game = game.start_new_game(question_key)
+        return game
+
+    def _publish(self, game, version):
+        """
+        Stores `game` in memcache under a new version, unless another
+        instance has published since `version`
+
+        Returns the new version, or None if another instance published first
+        """
+        client = memcache.Client()
+        token = uuid.uuid4().hex
+        cached = client.gets(self.GAME_KEY)
+        if cached is None:
+            if not client.add(self.GAME_KEY, (token, game)):
+                if client.get(self.GAME_KEY) is not None:
+                    return None
+                logging.error("memcache unavailable, game state not shared")
+                return token
+        elif cached[0] != version:
+            return None
+        elif not client.cas(self.GAME_KEY, (token, game)):
+            return None
+        client.set(self.VERSION_KEY, token)
+        return token
+
+    def _checkpoint_due(self):
+        if self.checkpointed_at is None:
+            return True
+        elapsed = datetime.datetime.now() - self.checkpointed_at
+        return elapsed.seconds >= self.checkpoint_interval
@@ -1,30 +1,141 @@
 from google.appengine.ext import ndb
-from google.appengine.api import memcache
+from google.appengine.api import memcache, datastore_errors
 import datetime
+import hashlib
 import random
 import logging
+import time
 from collections import defaultdict
 import copy
 
-from .concept import Predicate, Concept
-from .player import Player
-from .question import Question, QuestionTemplate
+from .concept import Predicate, Concept, DataVersion, GameCreationException
+from .player import Player, Leaderboard, ScoreShard
+from .question import Question, QuestionTemplate, UsageEpoch, \
+        template_sampler, question_pool
 
 
-class GameCreationException(Exception):
+def normalize_answer(answer):
     """
-    A special exception for when a game is created with a bad concept
+    Canonical form of an answer: lower case with single spaces
     """
-    pass
+    return ' '.join(answer.lower().split())
+
 
 class Answer(ndb.Model):
     """
-    Temporary data structure that contains a person's response.
-    These are embedded into Game instance.
+    A person's response to a round.
+
+    Answers are stored outside of the Game, in one entity group per round
+    and player, and are keyed by a hash of the normalized answer.  Players
+    never contend with each other when they submit, and submitting the same
+    answer twice writes the same entity.
     """
-    answer = ndb.StringProperty(indexed=True)
+    round_id = ndb.StringProperty(indexed=True)
+    answer = ndb.StringProperty(indexed=False)
     player_name = ndb.StringProperty()
     player_key = ndb.KeyProperty(Player, indexed=True)
+    created_at = ndb.DateTimeProperty(auto_now_add=True)
+
+    @classmethod
+    def shard_key(cls, round_id, player_name):
+        """
+        Parent of all the answers a player gave in a round
+        """
+        return ndb.Key('AnswerShard', '%s:%s' % (round_id, player_name))
+
+    @classmethod
+    def key_for(cls, round_id, player_name, answer):
+        """
+        Hashed, as answers can be longer than a key name may be
+        """
+        answer = normalize_answer(answer)
+        if isinstance(answer, unicode):
+            answer = answer.encode('utf-8')
+        return ndb.Key(cls, hashlib.sha1(answer).hexdigest(),
+                       parent=cls.shard_key(round_id, player_name))
+
+    @classmethod
+    def store(cls, round_id, player_name, player_key, answer):
+        """
+        Saves an answer of a round, normalized.  Count it into the game's
+        tallies with Game.add_answer.
+        """
+        answer = normalize_answer(answer)
+        cls(key=cls.key_for(round_id, player_name, answer),
+            round_id=round_id,
+            player_name=player_name,
+            answer=answer,
+            player_key=player_key).put()
+
+    @classmethod
+    def index_round(cls, round_id):
+        """
+        Maps each player to the set of answers they gave in a round, and
+        each player who answered to their Player key.  Both come from the
+        same query so they always agree.
+        """
+        index = {}
+        player_keys = {}
+        for a in cls.query(cls.round_id==round_id).fetch(batch_size=1000):
+            index.setdefault(a.player_name, set()).add(a.answer)
+            player_keys[a.player_name] = a.player_key
+        return index, player_keys
+
+
+class RoundScore(ndb.Model):
+    """
+    The scores of a round.
+
+    The entity is created when a request claims the scoring of the round,
+    so a round is scored once even when requests on several instances reach
+    its answer round together.
+    """
+    CLAIM_SECONDS = 20  # after which an unfinished claim can be taken over
+
+    scores = ndb.PickleProperty()  # the round's cached_status, once computed
+    claimed_at = ndb.DateTimeProperty()
+
+    @classmethod
+    def claim(cls, round_id):
+        """
+        Returns True iff the caller should score the round
+        """
+        score = ndb.Key(cls, round_id).get()
+        if score is not None and score.is_claimed():
+            return False
+        try:
+            return cls._claim(round_id)
+        except datastore_errors.TransactionFailedError:
+            # somebody else is claiming it
+            return False
+
+    @classmethod
+    @ndb.transactional
+    def _claim(cls, round_id):
+        score = ndb.Key(cls, round_id).get()
+        if score is not None and score.is_claimed():
+            return False
+        cls(key=ndb.Key(cls, round_id), claimed_at=datetime.datetime.now()).put()
+        return True
+
+    @classmethod
+    def finish(cls, round_id, scores):
+        cls(key=ndb.Key(cls, round_id), claimed_at=datetime.datetime.now(),
+            scores=scores).put()
+
+    @classmethod
+    def scores_of(cls, round_id):
+        """
+        The scores of a round, or None if they are not computed yet
+        """
+        score = ndb.Key(cls, round_id).get()
+        return score.scores if score else None
+
+    def is_claimed(self):
+        if self.scores is not None:
+            return True
+        elapsed = datetime.datetime.now() - self.claimed_at
+        return elapsed < datetime.timedelta(seconds=self.CLAIM_SECONDS)
 
 
 class Game(ndb.Model):
@@ -44,54 +155,102 @@ class Game(ndb.Model):
     question = ndb.KeyProperty(Question)
     question_string = ndb.StringProperty()
     players = ndb.StringProperty(repeated=True)
-    answers = ndb.StructuredProperty(Answer, repeated=True)
+    round_id = ndb.StringProperty()
+    # running tallies of this round's answers
+    answer_index = ndb.PickleProperty()   # player name -> set of answers
+    answer_counts = ndb.PickleProperty()  # answer -> number of players
+    count_versions = ndb.PickleProperty() # answer -> status_version of last change
+    player_keys = ndb.PickleProperty()    # player name -> Player key
     background_color = ndb.IntegerProperty()
     times_played = ndb.IntegerProperty(default=0)
 
     cached_status = ndb.PickleProperty()
-    is_dirty = ndb.BooleanProperty(default=False)
+    # increases whenever the status sent to clients changes, see
+    # bump_status_version
+    status_version = ndb.IntegerProperty(default=0)
+    round_version = ndb.IntegerProperty(default=0)
 
     flagged_irrelevant = ndb.IntegerProperty(default=0)
     flagged_nonsense = ndb.IntegerProperty(default=0)
     
     is_banned = ndb.BooleanProperty(default=False) 
 
+    @classmethod
+    def singleton_key(cls):
+        """
+        Key of the one game everybody plays
+        """
+        return ndb.Key('Game', 'singleton')
+
+    def mark_dirty(self):
+        """
+        Records a change for the engine to write on its next flush, instead
+        of putting the game right away
+        """
+        self._pending_writes = self.pending_writes() + 1
+
+    def pending_writes(self):
+        """
+        Number of changes made since the engine last flushed the game
+        """
+        return getattr(self, '_pending_writes', 0)
+
+    def bump_status_version(self):
+        """
+        Increases status_version and returns it.
+
+        Versions follow the clock, in milliseconds, rather than counting
+        from the stored one: a game reloaded from an older checkpoint must
+        not hand out versions that clients have already seen.
+        """
+        self.status_version = max(self.status_version + 1,
+                                  int(time.time() * 1000))
+        return self.status_version
+
     def flag(self, reason):
         """
         Add as a bad question
 
         1 - Nonsense
         2 - Irrelevant
+
+        Returns the key of the question if it should now be banned
         """
         if reason == 1:
             self.flagged_nonsense += 1
         else:
             # problem_type = 2
             self.flagged_irrelevant += 1
+        self.mark_dirty()
 
         percent_flagged = float(len(self.players)) / self.times_flagged
         logging.error("%f percent flagged" % (percent_flagged))
         if self.times_flagged > 1 and percent_flagged > 0.34 and \
                 self.duration() > 1.5 and self.duration() < 10:
-            # ban the question
-            question = self.question.get()
-            question.is_banned = True
+            # ban the game; the caller bans the question
             self.is_banned = True
-            ndb.put_multi([self, question])
             logging.info("Question banned")
-            return True
-        return False
+            return self.question
+        return None
 
     @property
     def times_flagged(self):
         """ Total number of times flagged """
         return self.flagged_irrelevant + self.flagged_nonsense
 
-    def generate_question(self):
+    @classmethod
+    def generate_question(cls, previous=None):
         """
-        Finds a new question  that hasn't been used very often
+        Finds a new question  that hasn't been used very often, other than
+        the `previous` one.
+
+        Pooled questions are popped from memcache and new ones are put as
+        they are grounded, so call it outside of any transaction.
         """
-        question = None
+        question = cls._pop_pooled_question(previous)
+        if question:
+            return question
+        question_pool.request_refill()
         for _ in range(15): 
             try:
                 # pick a random question-template
@@ -100,7 +259,7 @@ class Game(ndb.Model):
                 question = question_template.ground()
                 if question.is_banned:
                     raise GameCreationException("Grounded question was banned")
-                if self.question == question:
+                if previous == question.key:
                     # don't play 2x in a row
                     raise GameCreationException("Game played too recently")
                 break
@@ -109,125 +268,205 @@ class Game(ndb.Model):
 
         return question 
 
-    def start_new_game(self):
+    @classmethod
+    def _pop_pooled_question(cls, previous):
         """
-        Starts a new game
+        Returns a playable question from the pool of grounded ones, or None
+        """
+        for _ in range(question_pool.SIZE):
+            key = question_pool.pop()
+            if key is None:
+                return None
+            question = key.get()
+            # questions can be banned while they wait in the pool
+            if question and not question.is_banned and key != previous:
+                return question
+        return None
+
+    def start_new_game(self, question_key):
+        """
+        Starts a new game with a question from generate_question.
+
+        The question and its template are read here, so this can run in a
+        transaction that is retried.  Record the play with
+        template_sampler.record_use once it committed.
         """
-        question = self.generate_question()
+        question = question_key.get()
         question_template = question.question_template.get()
         question.times_used += 1
+        question_template.normalize_usage(UsageEpoch.current())
         question_template.times_used += 1
 
         # reset the game 
         self.question_string = question.question
         self.question = question.key
         self.started_at = datetime.datetime.now()
-        self.answers = []
+        self.round_id = self.started_at.strftime('%Y%m%d%H%M%S%f')
+        self.answer_index = {}
+        self.answer_counts = {}
+        self.count_versions = {}
+        self.player_keys = {}
         self.background_color = random.choice(Game.GAME_COLORS) 
         self.cached_status = None
-        self.is_dirty = False
         self.players = []
         self.times_played += 1
         self.is_banned = False
         self.flagged_irrelevant = 0
         self.flagged_nonsense = 0
+        self.round_version = self.bump_status_version()
         # save the question and the game
         ndb.put_multi([self, question, question_template])
         return self
 
-    def _get_cached_status(self, force_answer=False):
-        """
-        This function computes the score or returns the cache in two ways, depending
-        on whether the game is still going on, or if the answers need to be computed
-        """
-        is_answer_round = Game.GAME_DURATION - self.duration() <= Game.ANSWER_DURATION
-        has_updated = False
-        if is_answer_round or force_answer:
-            # compute if:  non-answer-round cache, or no cache
-            if not (self.cached_status and self.cached_status.has_key('player_scores')):
-                """
-                Here is where all the results are computed, new concepts are added,
-                and new predicates are created
-                """
-                has_updated = True
-                unsaved = []   # new records to create 
-                counts = defaultdict(int)
-                answers_by_players = defaultdict(list)
-                # type of answer
-                question = self.question.get()
-                qt = question.question_template.get()
-                arguments = [a.name for a in ndb.get_multi(question.arguments)]
-                argument_types = qt.argument_types
-                predicate = qt.predicate_name
-                answer_type = question.answer_type
-
-                # counts answers
-                for answer in self.answers:
-                    # TODO: filter bad concepts (e.g. bad words, single letters)
-                    counts[answer.answer] += 1
-                    answers_by_players[answer.player_name].append(answer.answer)
-
-                # computes scores for each answer
-                scores = {}
-                for answer, count in counts.items():
-                    scores[answer] = (count-1) * 2
-                    # create concept for scores with more than 1 count
-                    if count > 1:
-                        c = Concept.get_or_create(name=answer)
-                        c.add_concept_type("concept")
-                        c.add_concept_type(answer_type)
-                        unsaved.append(c)
-                    # create a new predicate
-                    p = Predicate.update_or_create(predicate,
-                            arguments + [answer],
-                            argument_types + [answer_type],
-                            self.question,
-                            count)
-                    unsaved.append(p)
-
-                # computes scores for each player    
-                player_scores = defaultdict(int)
-                for answer in self.answers:
-                    player_scores[answer.player_name] += scores[answer.answer]
-
-                # update the players' scores
-                new_player_scores = {}
-                for player in player_scores:
-                    # find player and add score
-                    p = Player.query(Player.username==player).get()
-                    p.score += player_scores[player]
-                    new_player_scores["%s (%i)" % (player, p.score)] = player_scores[player]
-                    unsaved.append(p)
-
-
-                # store in cached_status
-                self.cached_status = {'player_scores': dict(new_player_scores),
-                                      'counts': dict(counts),
-                                      'scores':  scores,
-                                      'answers_by_players': dict(answers_by_players)}
-                # save all of these
-                ndb.put_multi(unsaved)
-
-        elif self.is_dirty or not self.cached_status:
-            # compute game-in-progress status
-            has_updated = True
-            counts = defaultdict(int)
-            answers_by_players = defaultdict(list)
-            for answer in self.answers:
-                counts[answer.answer] += 1
-                answers_by_players[answer.player_name].append(answer.answer)
-
-            # store in cached_status
-            self.cached_status = {'counts': dict(counts),
-                                  'answers_by_players': dict(answers_by_players)}
-
-        if has_updated:
-            # reset dirty flag and save it
-            self.is_dirty = False
-            self.put()
-
-        # ultimately, return status 
-        return has_updated, copy.copy(self.cached_status)
+    def needs_scoring(self, force_answer=False):
+        """
+        True if the answer round is due, or forced, but not scored yet
+        """
+        return (self.is_answer_round() or force_answer) and \
+                not (self.cached_status and self.cached_status.has_key('player_scores'))
+
+    def scoring_snapshot(self):
+        """
+        Copies of the arguments of Game.score, so the round can be scored
+        without holding on to the live game
+        """
+        counts, answers_by_players, _ = self._get_tallies()
+        return (self.question, dict(counts),
+                dict((player, set(answers))
+                     for player, answers in answers_by_players.items()),
+                dict(self._get_player_keys()))
+
+    @classmethod
+    def score(cls, question_key, counts, answers_by_players, player_keys):
+        """
+        Scores a round from a scoring_snapshot and returns its status
+
+        Here is where all the results are computed, new concepts are added,
+        and new predicates are created
+        """
+        unsaved = []   # new records to create 
+        # ground the next questions while the players look at scores
+        question_pool.request_refill()
+        # type of answer
+        question = question_key.get()
+        qt = question.question_template.get()
+        arguments = [a.name for a in ndb.get_multi(question.arguments)]
+        argument_types = qt.argument_types
+        predicate = qt.predicate_name
+        answer_type = question.answer_type
+
+        # computes scores for each answer
+        # TODO: filter bad concepts (e.g. bad words, single letters)
+        scores = {}
+        assertions = []
+        agreed = []
+        for answer, count in counts.items():
+            scores[answer] = (count-1) * 2
+            # create concept for scores with more than 1 count
+            if count > 1:
+                agreed.append(answer)
+            # create a new predicate
+            assertions.append((predicate,
+                               arguments + [answer],
+                               argument_types + [answer_type],
+                               count))
+        unsaved.extend(Predicate.update_or_create_multi(assertions,
+                                                        question_key))
+        for c in Concept.get_or_create_multi(agreed):
+            c.add_concept_type("concept")
+            c.add_concept_type(answer_type)
+            unsaved.append(c)
+
+        # computes scores for each player    
+        player_scores = defaultdict(int)
+        for player, answers in answers_by_players.items():
+            for answer in answers:
+                player_scores[player] += scores[answer]
+
+        # add to the players' score counters; their totals are the
+        # rolled up score plus whatever is still pending
+        for player in player_scores.keys():
+            if player not in player_keys:
+                logging.error("No Player key for %s" % (player))
+                del player_scores[player]
+        keys = [player_keys[player] for player in player_scores]
+        players = ndb.get_multi(keys)
+        pending = ScoreShard.pending_totals(keys)
+        ScoreShard.increment_multi(dict((player_keys[player], points)
+                for player, points in player_scores.items()))
+        new_player_scores = {}
+        total_scores = {}
+        for player, p in zip(player_scores, players):
+            if p is None:
+                logging.error("Player %s not found" % (player))
+                continue
+            total = p.score + pending[p.key] + player_scores[player]
+            new_player_scores["%s (%i)" % (player, total)] = player_scores[player]
+            total_scores[player] = total
+
+        cached_status = {'player_scores': dict(new_player_scores),
+                         'counts': dict(counts),
+                         'scores':  scores,
+                         'answers_by_players': dict((player, list(answers))
+                             for player, answers in answers_by_players.items()),
+                         'total_scores': total_scores,
+                         'count_versions': {}}
+        # save all of these
+        ndb.put_multi(unsaved)
+        concepts = [c for c in unsaved if isinstance(c, Concept)]
+        Concept.index_new_types(concepts)
+        if assertions:
+            DataVersion.bump('Predicate')
+        if concepts:
+            DataVersion.bump('Concept')
+        Leaderboard.record(total_scores)
+        return cached_status
+
+    def set_scores(self, round_id, cached_status):
+        """
+        Records the scores of the round, unless it is over or scored already
+
+        Returns True if changed
+        """
+        if round_id != self.round_id or not self.needs_scoring(True):
+            return False
+        self.cached_status = cached_status
+        self.bump_status_version()
+        self.mark_dirty()
+        return True
+
+    def _get_tallies(self):
+        """
+        The running tallies of the round: how many players gave each answer,
+        the answers of each player, and the status_version at which each
+        count last changed.  Counts are rebuilt from the answer index if the
+        game was saved without them.
+        """
+        self._load_answers()
+        if self.answer_counts is None:
+            self.answer_counts = {}
+            self.count_versions = {}
+            for answers in self.answer_index.values():
+                for answer in answers:
+                    self.answer_counts[answer] = self.answer_counts.get(answer, 0) + 1
+                    self.count_versions[answer] = self.status_version
+        return self.answer_counts, self.answer_index, self.count_versions
+
+    def _get_player_keys(self):
+        """
+        The Player key of everyone who answered this round
+        """
+        self._load_answers()
+        return self.player_keys
+
+    def _load_answers(self):
+        """
+        Rebuilds the answer index and the player keys from the answers of
+        the round if the game was saved without either of them
+        """
+        if self.answer_index is None or self.player_keys is None:
+            self.answer_index, self.player_keys = Answer.index_round(self.round_id)
+            self.answer_counts = None
 
     def add_player(self, player_name):
         """
@@ -237,17 +476,36 @@ class Game(ndb.Model):
         """
         if not player_name in self.players:
             self.players.append(player_name)
-            self.put()
+            self.bump_status_version()
+            self.mark_dirty()
             return True
         return False
 
 
-    def status(self, player_name, force_answer=False):
+    def status(self, player_name, force_answer=False, since=None):
         """  
         Personalizes the status for the particular player
+
+        `since` is the status_version the player last saw.  If nothing
+        changed since then only the new version is returned, and while the
+        round is in progress only the counts that changed are sent.
+
+        The status is read from the game alone.  Once the round is scored
+        the total_score of a player who did not answer is left as None for
+        the caller to look up with Game.total_score_of.
         """
-        self.add_player(player_name)
-        has_changed, status = self._get_cached_status(force_answer)
+        if (self.is_answer_round() or force_answer) and not self.needs_scoring(True):
+            status = copy.copy(self.cached_status)
+        else:
+            # game-in-progress status, straight from the tallies
+            counts, answers_by_players, count_versions = self._get_tallies()
+            status = {'counts': counts,
+                      'answers_by_players': answers_by_players,
+                      'count_versions': count_versions}
+        is_delta = since is not None and since >= self.round_version
+        if is_delta and since >= self.status_version:
+            return {'not_modified': True,
+                    'status_version': self.status_version}
         # personalize 
         if 'scores' in status:
             # this is the answer round
@@ -259,8 +517,7 @@ class Game(ndb.Model):
                 user_scores[answer] = status['scores'][answer]
                 round_score += status['scores'][answer]
 
-            p = Player.query(Player.username==player_name).get()
-            total_score = p.score 
+            total_score = status.get('total_scores', {}).get(player_name)
             status['counts'] = user_counts
             status['user_scores'] = user_scores
             status['round_score'] = round_score
@@ -268,12 +525,29 @@ class Game(ndb.Model):
         else:
             # this is just the regular round
             user_counts = {}
+            count_versions = status.get('count_versions', {})
             for answer in status['answers_by_players'].get(player_name, []):
+                if is_delta and count_versions.get(answer, 0) <= since:
+                    continue
                 user_counts[answer] = status['counts'][answer]
             status['counts'] = user_counts
+            status['delta'] = is_delta
 
         del status['answers_by_players']
-        return has_changed, status
+        status.pop('total_scores', None)
+        status.pop('count_versions', None)
+        status['status_version'] = self.status_version
+        return status
+
+    @staticmethod
+    def total_score_of(player_name):
+        """
+        A player's score, including the points not rolled up yet
+        """
+        p = Player.query(Player.username==player_name).get()
+        if p is None:
+            return 0
+        return p.score + ScoreShard.pending_totals([p.key])[p.key]
 
     def duration(self):
         """
@@ -284,23 +558,47 @@ class Game(ndb.Model):
         else:
             return 1000000000000
 
-    def add_answer(self, player_name, player_key, answer):
+    def is_answer_round(self):
+        """
+        True once the question phase is over and the answers are scored
+        """
+        return Game.GAME_DURATION - self.duration() <= Game.ANSWER_DURATION
+
+    def is_finished(self):
+        """
+        True once the round has run out of time or has been banned
+        """
+        return self.is_banned or self.duration() > Game.GAME_DURATION
+
+    def add_answer(self, round_id, player_name, player_key, answer):
         """
-        Adds an answer as a child to the game instance
+        Counts an answer, stored beforehand with Answer.store, into the
+        tallies of the round.  The game itself is saved by the engine.
 
         Returns True if changed
         """
-        for a in self.answers:
-            if a.player_key == player_key and a.answer == answer:
-                return False
+        answer = normalize_answer(answer)
+        if not answer or round_id != self.round_id:
+            return False
+        counts, _, count_versions = self._get_tallies()
+        given = self.answers_of(player_name)
+        if answer in given:
+            return False
 
         if not player_name in self.players:
             self.players.append(player_name)
-        new_answer = Answer(parent=self.key,
-                        player_name=player_name,
-                        answer=answer,
-                        player_key=player_key)
-        self.answers.append(new_answer)
-        self.is_dirty = True
-        self.put()
+        self._get_player_keys()[player_name] = player_key
+        # update the tallies
+        self.bump_status_version()
+        given.add(answer)
+        counts[answer] = counts.get(answer, 0) + 1
+        count_versions[answer] = self.status_version
+        self.mark_dirty()
         return True
+
+    def answers_of(self, player_name):
+        """
+        The set of answers a player gave this round
+        """
+        _, answer_index, _ = self._get_tallies()
+        return answer_index.setdefault(player_name, set())
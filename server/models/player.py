@@ -1,4 +1,6 @@
 from google.appengine.ext import ndb
+from collections import defaultdict
+import random
 
 
 class Player(ndb.Model):
@@ -18,3 +20,128 @@ class Player(ndb.Model):
         return {'username': self.username,
                 'key': self.key.urlsafe()}
 
+
+class Leaderboard(ndb.Model):
+    """
+    The top players, kept up to date as round scores are applied so the
+    leaderboard can be shown without querying every player
+    """
+    SIZE = 100
+
+    entries = ndb.PickleProperty()  # [{'username': ..., 'score': ...}], best first
+
+    @classmethod
+    def leaderboard_key(cls):
+        return ndb.Key(cls, 'top')
+
+    @classmethod
+    def get_top(cls):
+        """
+        Returns the leaderboard entries, building them the first time
+        """
+        leaderboard = cls.leaderboard_key().get()
+        if leaderboard is None:
+            leaderboard = cls(key=cls.leaderboard_key(), entries=[
+                {'username': p.username, 'score': p.score} for p in
+                Player.query().order(-Player.score).fetch(cls.SIZE)])
+            leaderboard.put()
+        return leaderboard.entries
+
+    @classmethod
+    @ndb.transactional
+    def record(cls, updated):
+        """
+        Merges a username -> new total score mapping into the leaderboard.
+        Scores only go up, so nobody outside of it can overtake them.
+        """
+        leaderboard = cls.leaderboard_key().get()
+        if leaderboard is None:
+            return
+        entries = [e for e in leaderboard.entries if e['username'] not in updated]
+        entries.extend({'username': username, 'score': score}
+                       for username, score in updated.items())
+        entries.sort(key=lambda e: -e['score'])
+        leaderboard.entries = entries[:cls.SIZE]
+        leaderboard.put()
+
+
+class ScoreShard(ndb.Model):
+    """
+    One of NUM_SHARDS counters that absorb a player's score increments.
+
+    Rounds add their points to a random shard, so concurrent increments
+    rarely touch the same entity.  ScoreShard.rollup() periodically folds
+    the pending points into Player.score, which the leaderboard and the
+    score ordering use.
+    """
+    NUM_SHARDS = 5
+
+    player = ndb.KeyProperty(Player)
+    pending = ndb.IntegerProperty(default=0)
+
+    @classmethod
+    def shard_keys(cls, player_key):
+        return [ndb.Key(cls, '%s:%i' % (player_key.id(), i))
+                for i in range(cls.NUM_SHARDS)]
+
+    @classmethod
+    def pending_totals(cls, player_keys):
+        """
+        Maps each player key to the points not yet rolled up, with a
+        single get_multi
+        """
+        shard_keys = []
+        for player_key in player_keys:
+            shard_keys.extend(cls.shard_keys(player_key))
+        totals = dict((player_key, 0) for player_key in player_keys)
+        for shard in ndb.get_multi(shard_keys):
+            if shard is not None:
+                totals[shard.player] += shard.pending
+        return totals
+
+    @classmethod
+    def increment_multi(cls, increments):
+        """
+        Adds a player key -> points mapping to the players' counters, one
+        transaction per player, all in parallel
+        """
+        futures = [cls._increment_async(player_key, points)
+                   for player_key, points in increments.items() if points]
+        ndb.Future.wait_all(futures)
+        for future in futures:
+            future.check_success()
+
+    @classmethod
+    @ndb.transactional_tasklet
+    def _increment_async(cls, player_key, points):
+        key = random.choice(cls.shard_keys(player_key))
+        shard = yield key.get_async()
+        if shard is None:
+            shard = cls(key=key, player=player_key)
+        shard.pending += points
+        yield shard.put_async()
+
+    @classmethod
+    def rollup(cls, limit=500):
+        """
+        Folds the pending points of up to `limit` shards into their
+        players' scores.  Returns the number of players updated.
+        """
+        by_player = defaultdict(list)
+        for shard in cls.query(cls.pending > 0).fetch(limit):
+            by_player[shard.player].append(shard.key)
+        for player_key, shard_keys in by_player.items():
+            cls._fold(player_key, shard_keys)
+        return len(by_player)
+
+    @classmethod
+    @ndb.transactional(xg=True)
+    def _fold(cls, player_key, shard_keys):
+        entities = ndb.get_multi([player_key] + shard_keys)
+        player, shards = entities[0], [s for s in entities[1:] if s]
+        if player is None:
+            return
+        for shard in shards:
+            player.score += shard.pending
+            shard.pending = 0
+        ndb.put_multi([player] + shards)
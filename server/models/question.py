@@ -1,9 +1,123 @@
 import re
 import random
+import time
+import hashlib
+import json
 import logging
-from google.appengine.ext import ndb
+from google.appengine.ext import ndb, deferred
 from google.appengine.api import memcache
-from .concept import Concept
+from .concept import Concept, GameCreationException
+
+
+class TemplateSampler(object):
+    """
+    Keeps the question templates in memory, bucketed by times_used, so the
+    least used ones can be drawn without touching the datastore.
+
+    The buckets are loaded once per instance and reloaded every
+    RELOAD_SECONDS to pick up templates added, and games played, on other
+    instances.
+    """
+    RELOAD_SECONDS = 600
+
+    def __init__(self):
+        self.buckets = None  # times_used -> list of template keys
+        self.templates = {}  # template key -> (template, times_used)
+        self.loaded_at = 0
+
+    def least_used(self):
+        """
+        Returns a random template among the least used ones, or None
+        """
+        if self._is_stale():
+            self._load()
+        if not self.buckets:
+            return None
+        key = random.choice(self.buckets[min(self.buckets)])
+        return self.templates[key][0]
+
+    def least_used_many(self, count):
+        """
+        Returns up to `count` distinct templates, least used first
+        """
+        if count <= 0:
+            return []
+        if self._is_stale():
+            self._load()
+        chosen = []
+        for times_used in sorted(self.buckets):
+            keys = list(self.buckets[times_used])
+            random.shuffle(keys)
+            chosen.extend(self.templates[key][0] for key in keys[:count-len(chosen)])
+            if len(chosen) >= count:
+                break
+        return chosen
+
+    def record_use(self, template):
+        """
+        Moves a template up one bucket after it has been played
+        """
+        if self.buckets is None or template.key not in self.templates:
+            return
+        _, times_used = self.templates[template.key]
+        bucket = self.buckets[times_used]
+        bucket.remove(template.key)
+        if not bucket:
+            del self.buckets[times_used]
+        self._add(template, times_used + 1)
+
+    def invalidate(self):
+        self.buckets = None
+        self.templates = {}
+
+    def _is_stale(self):
+        return self.buckets is None or \
+                time.time() - self.loaded_at > self.RELOAD_SECONDS
+
+    def _load(self):
+        self.buckets = {}
+        self.templates = {}
+        epoch = UsageEpoch.current()
+        for template in QuestionTemplate.query(
+                ancestor=ndb.Key('Game', 'singleton')).fetch():
+            template.normalize_usage(epoch)
+            self._add(template, template.times_used)
+        self.loaded_at = time.time()
+
+    def _add(self, template, times_used):
+        self.templates[template.key] = (template, times_used)
+        self.buckets.setdefault(times_used, []).append(template.key)
+
+
+class UsageEpoch(ndb.Model):
+    """
+    The epoch the question templates' usage counters are counted in.
+
+    Counters recorded in an older epoch count as zero, so bumping the epoch
+    resets all of them at once.
+    """
+    epoch = ndb.IntegerProperty(default=0)
+
+    @classmethod
+    def epoch_key(cls):
+        return ndb.Key(cls, 'question_templates')
+
+    @classmethod
+    def current(cls):
+        usage_epoch = cls.epoch_key().get()
+        return usage_epoch.epoch if usage_epoch else 0
+
+    @classmethod
+    @ndb.transactional
+    def bump(cls):
+        """
+        Starts a new epoch and returns it
+        """
+        usage_epoch = cls.epoch_key().get() or cls(key=cls.epoch_key())
+        usage_epoch.epoch += 1
+        usage_epoch.put()
+        return usage_epoch.epoch
+
 
 class QuestionTemplate(ndb.Model):
     """
@@ -18,20 +132,37 @@ class QuestionTemplate(ndb.Model):
     answer_type = ndb.StringProperty()
 
     times_used = ndb.IntegerProperty(default=0)
+    epoch = ndb.IntegerProperty(default=0)  # UsageEpoch times_used counts in
     created_at = ndb.DateTimeProperty(auto_now_add=True)
 
+    @classmethod
+    def key_for(cls, question):
+        """
+        Templates loaded from fixtures are keyed by a hash of their question
+        """
+        if isinstance(question, unicode):
+            question = question.encode('utf-8')
+        return ndb.Key(cls, hashlib.sha1(question).hexdigest(),
+                       parent=ndb.Key('Game', 'singleton'))
+
     @classmethod
     def reset_all_usage_stats(cls):
         """
-        Sets all the time_used = 0
+        Sets all the time_used = 0, by starting a new usage epoch.  Each
+        template resets its own counter the next time it is read.
         """
-        to_update = []
-        for q in cls.query().fetch():
-            q.times_used=0
-            to_update.append(q)
-        ndb.put_multi(to_update)
+        UsageEpoch.bump()
+        template_sampler.invalidate()
         return True
 
+    def normalize_usage(self, epoch):
+        """
+        Resets times_used if it was counted in an older epoch
+        """
+        if self.epoch != epoch:
+            self.times_used = 0
+            self.epoch = epoch
+
     def extract_arguments(self):
         """
         Extracts the concept types from the arguments
@@ -67,7 +198,13 @@ class QuestionTemplate(ndb.Model):
 
     def ground(self):
         """ Populates the question template with concepts of the types and 
-        returns the grounded question string along with a list of the concept objects
+        returns the matching Question, creating it if needed
+        """
+        return Question.get_or_create_multi([self.fill()])[0]
+
+    def fill(self):
+        """ Picks a concept for each argument of the template.  Returns the
+        template, the grounded question string and the list of concept keys
         """
         grounded_string = self.question[:]
         concepts_list = []
@@ -80,22 +217,17 @@ class QuestionTemplate(ndb.Model):
             argument_value = "<b>%s</b>" % (argument.name,)
             grounded_string = grounded_string.replace(pattern, argument_value, 1) 
 
-        question = Question.get_or_create(question=grounded_string,
-                     question_template=self,
-                     arguments=concepts_list,
-                     answer_type=self.answer_type)
-        return question
+        return self, grounded_string, concepts_list
 
     @classmethod
     def get_random(cls):
         """
         Returns random minimally used template
         """
-        a = ndb.Key('Game', 'singleton')
-        min_used = cls.query(ancestor=a).order(cls.times_used).get().times_used
-        templates = cls.query(cls.times_used==min_used,
-                ancestor=a).fetch()
-        return templates[random.randint(0, len(templates)-1)]
+        template = template_sampler.least_used()
+        if template is None:
+            raise GameCreationException("There are no question templates")
+        return template
 
 
 
@@ -112,32 +244,190 @@ class Question(ndb.Model):
 
     is_banned = ndb.BooleanProperty(default=False)
 
+    LEGACY_CHECK_SECONDS = 600
+    LEGACY_BATCH_SIZE = 30  # questions per IN query
+    _has_legacy = None
+    _legacy_checked_at = 0
+
+    @classmethod
+    def key_for(cls, question_template_key, arguments):
+        """
+        Questions are keyed by a hash of their template and their ordered
+        argument keys
+        """
+        canonical = json.dumps([question_template_key.flat()] +
+                               [argument.flat() for argument in arguments])
+        return ndb.Key(cls, hashlib.sha1(canonical).hexdigest())
 
     @classmethod
     def get_or_create(cls, question_template, question, arguments, answer_type):
         """
         Retrieves the question or creates a new one
         """
-        if len(arguments) > 0:
-            q = ndb.gql(""" SELECT * FROM Question 
-                            WHERE ANCESTOR IS KEY('Game', 'singleton')
-                            AND question_template = :1
-                            AND arguments IN :2""", question_template.key, arguments).get()
-        else:
-            q = ndb.gql(""" SELECT * FROM Question 
-                            WHERE ANCESTOR IS KEY('Game', 'singleton')
-                            AND question_template = :1""",
-                            question_template.key).get()
-
-                        
+        key = cls.key_for(question_template.key, arguments)
+        q = key.get()
         if not q:
-            q = cls(question_template=question_template.key,
+            q = cls(key=key,
+                    question_template=question_template.key,
                     question=question,
                     arguments=arguments,
                     answer_type=answer_type)
             q.put()
-            return q
         return q
 
+    @classmethod
+    def get_or_create_multi(cls, groundings):
+        """
+        Retrieves or creates the questions for a list of
+        (question_template, question string, argument keys) groundings, with
+        one get_multi and one put_multi.  Returns them in order.
+
+        Questions saved before they were keyed by hash have auto-assigned
+        ids, and a grounding can have several of them.  While any are left,
+        a new question takes over their ban and their number of uses, so
+        banned questions stay banned.
+        """
+        keys = [cls.key_for(qt.key, arguments) for qt, _, arguments in groundings]
+        by_key = {}
+        for key, q in zip(keys, ndb.get_multi(keys)):
+            if q is not None:
+                by_key[key] = q
+
+        missing = [(key, qt, question) for key, (qt, question, _) in
+                   zip(keys, groundings) if key not in by_key]
+        legacy = cls._find_legacy(missing) if missing and cls.has_legacy() else {}
+        created = []
+        for key, (qt, question, arguments) in zip(keys, groundings):
+            if key not in by_key:
+                q = cls(key=key,
+                        question_template=qt.key,
+                        question=question,
+                        arguments=arguments,
+                        answer_type=qt.answer_type)
+                for old in legacy.get((qt.key, question), []):
+                    q.is_banned = q.is_banned or old.is_banned
+                    q.times_used += old.times_used
+                by_key[key] = q
+                created.append(q)
+        ndb.put_multi(created)
+        return [by_key[key] for key in keys]
+
+    @classmethod
+    def has_legacy(cls):
+        """
+        True while some questions still have auto-assigned ids.  Ids sort
+        before names, so the first key tells; it is checked once every
+        LEGACY_CHECK_SECONDS.
+        """
+        if cls._has_legacy is None or \
+                time.time() - cls._legacy_checked_at > cls.LEGACY_CHECK_SECONDS:
+            first = cls.query().order(cls.key).get(keys_only=True)
+            cls._has_legacy = first is not None and \
+                    not isinstance(first.id(), basestring)
+            cls._legacy_checked_at = time.time()
+        return cls._has_legacy
+
+    @classmethod
+    def _find_legacy(cls, missing):
+        """
+        Maps (template key, question string) to the questions with
+        auto-assigned ids that have them, with one IN query per
+        LEGACY_BATCH_SIZE questions
+        """
+        asked = sorted(set(question for _, _, question in missing))
+        futures = [cls.query(cls.question.IN(asked[i:i + cls.LEGACY_BATCH_SIZE]))
+                .fetch_async()
+                for i in range(0, len(asked), cls.LEGACY_BATCH_SIZE)]
+        found = {}
+        for future in futures:
+            for q in future.get_result():
+                if not isinstance(q.key.id(), basestring):
+                    found.setdefault((q.question_template, q.question), []).append(q)
+        return found
+
     def __str__(self):
         return self.question
+
+
+class QuestionPool(object):
+    """
+    Grounded questions ready to be played.
+
+    The keys of the questions are kept in memcache and refilled by a
+    deferred task, usually while a round is being scored, so starting a
+    round pops one instead of grounding templates on the spot.
+    """
+    POOL_KEY = 'question_pool'
+    REFILL_KEY = 'question_pool_refill'
+    SIZE = 10
+    CAS_RETRIES = 5
+
+    def pop(self):
+        """
+        Returns the key of a grounded question, or None if the pool is empty
+        """
+        client = memcache.Client()
+        for _ in range(self.CAS_RETRIES):
+            keys = client.gets(self.POOL_KEY)
+            if not keys:
+                return None
+            if client.cas(self.POOL_KEY, keys[1:]):
+                return keys[0]
+        return None
+
+    def push(self, keys):
+        """
+        Adds question keys at the end of the pool
+        """
+        client = memcache.Client()
+        for _ in range(self.CAS_RETRIES):
+            pool = client.gets(self.POOL_KEY)
+            if pool is None:
+                if client.add(self.POOL_KEY, list(keys)):
+                    return True
+            elif client.cas(self.POOL_KEY, pool + list(keys)):
+                return True
+        logging.error("Could not add %i questions to the pool" % (len(keys)))
+        return False
+
+    def request_refill(self):
+        """
+        Starts a background refill, unless one is already running
+        """
+        if memcache.add(self.REFILL_KEY, True, time=60):
+            deferred.defer(refill_question_pool)
+
+    def refill(self):
+        """
+        Grounds the least used templates until the pool is full again
+        """
+        try:
+            missing = self.SIZE - len(memcache.get(self.POOL_KEY) or [])
+            if missing <= 0:
+                # overlapping refills already filled it
+                return
+            groundings = []
+            for template in template_sampler.least_used_many(missing):
+                try:
+                    groundings.append(template.fill())
+                except GameCreationException as msg:
+                    logging.info("Could not ground %s: %s" % (template.key, msg))
+            keys = []
+            for question in Question.get_or_create_multi(groundings):
+                if not question.is_banned and question.key not in keys:
+                    keys.append(question.key)
+            if keys:
+                self.push(keys)
+        finally:
+            memcache.delete(self.REFILL_KEY)
+
+
+def refill_question_pool():
+    """
+    Entry point of the deferred refill task
+    """
+    question_pool.refill()
+
+
+template_sampler = TemplateSampler()
+question_pool = QuestionPool()
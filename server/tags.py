@@ -1,9 +1,42 @@
 from jinja2.ext import Extension
+from jinja2 import nodes
+from google.appengine.api import memcache
 import inspect 
 import os
 import re
 from datetime import date, datetime, timedelta
 
+class FragmentCacheExtension(Extension):
+    """
+    Caches the output of a block in memcache:
+
+        {% cache "name", version %} ... {% endcache %}
+
+    The block is only rendered again once `version` changes, so anything it
+    iterates over, like a query, is not run while the fragment is cached.
+    """
+    tags = set(['cache'])
+    TIMEOUT = 60 * 60  # seconds, lets fragments of old versions expire
+
+    def parse(self, parser):
+        lineno = parser.stream.next().lineno
+        args = [parser.parse_expression()]
+        if parser.stream.skip_if('comma'):
+            args.append(parser.parse_expression())
+        else:
+            args.append(nodes.Const(None))
+        body = parser.parse_statements(['name:endcache'], drop_needle=True)
+        return nodes.CallBlock(self.call_method('_cache_support', args),
+                               [], [], body).set_lineno(lineno)
+
+    def _cache_support(self, name, version, caller):
+        key = 'fragment:%s:%s' % (name, version)
+        rv = memcache.get(key)
+        if rv is None:
+            rv = caller()
+            memcache.set(key, rv, time=self.TIMEOUT)
+        return rv
+
 def active(request, pattern):
     import re
     if re.search(pattern, request):
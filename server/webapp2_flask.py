@@ -10,6 +10,7 @@ from google.appengine.ext.webapp import util
 from google.appengine.api import users, memcache
 
 from webapp2_extras import sessions, jinja2, auth
+from jinja2 import MemcachedBytecodeCache
 from webapp2_extras.auth import InvalidAuthIdError
 from webapp2_extras.auth import InvalidPasswordError
 import tags
@@ -20,26 +21,52 @@ try:
 except ImportError:
     from django.utils import simplejson
 
+class JSONFragment(object):
+    """ Already encoded JSON, spliced as is into the responses of
+    `Webapp.render_json` when it is one of the values of the top level
+    dictionary.
+    """
+    def __init__(self, encoded):
+        self.encoded = encoded
+
 class Webapp(webapp2.WSGIApplication):
 
     def __init__(self, *args, **kwargs):
         super(Webapp, self).__init__(*args, **kwargs)
+        # path without trailing slash -> (handler, methods) of the routes
+        # registered with sessions=False
+        self.router.sessionless_routes = {}
         self.router.set_dispatcher(self.__class__.custom_dispatcher)
 
     @staticmethod
     def custom_dispatcher(router, request, response):
-        rv = router.default_dispatcher(request, response)
+        sessionless = router.sessionless_routes.get(request.path.rstrip('/'))
+        if sessionless and (sessionless[1] is None or request.method in sessionless[1]):
+            # neither reads nor signs the session cookie
+            request.route_args, request.route_kwargs = (), {}
+            return Webapp.to_response(sessionless[0](request))
+        rv = Webapp.to_response(router.default_dispatcher(request, response))
         router.session_store = sessions.get_store(request=request)
+        router.session_store.save_sessions(rv)
+        return rv
+
+    @staticmethod
+    def to_response(rv):
         if isinstance(rv, basestring):
             rv = webapp2.Response(rv)
         elif isinstance(rv, tuple):
             rv = webapp2.Response(*rv)
-        router.session_store.save_sessions(rv)
         return rv
 
 
     def route(self, *args, **kwargs):
-        """ Defines the decorator for Flask-like route definitions """
+        """ Defines the decorator for Flask-like route definitions
+
+        Routes defined with `sessions=False` must not use the session, nor
+        take URL arguments.  They skip the session store, and are found
+        with a single lookup that ignores the trailing slash.
+        """
+        use_sessions = kwargs.pop('sessions', True)
         if 'admin' in kwargs and kwargs['admin']:
             # require the user be logged in
             del kwargs['admin']
@@ -84,6 +111,10 @@ class Webapp(webapp2.WSGIApplication):
         else:
             def wrapper(func):
                 self.router.add(webapp2.Route(handler=func, name=func.__name__, *args, **kwargs))
+                if not use_sessions:
+                    template = args[0] if args else kwargs['template']
+                    self.router.sessionless_routes[template.rstrip('/')] = \
+                            (func, kwargs.get('methods'))
                 #setattr(func, 'handler', '5')
                 return func
             return wrapper
@@ -99,6 +130,10 @@ class Webapp(webapp2.WSGIApplication):
         """
 
         j = jinja2.Jinja2(app)
+        # compiled templates are shared by every instance through memcache
+        j.environment.bytecode_cache = MemcachedBytecodeCache(memcache.Client(),
+                prefix='jinja2/bytecode/')
+        j.environment.add_extension(tags.FragmentCacheExtension)
         j.environment.filters.update({
             'active': tags.active,
             'naturaltime': tags.naturaltime,
@@ -180,16 +215,35 @@ class Webapp(webapp2.WSGIApplication):
       
         Arguments:
         json_data -- resulting data that needs to be converted into a JSON string.
-            Should be a `dict`.  If it is a string, the string itself is
-            assumed to be a JSON string and is returned directly.
+            Should be a `dict`, whose values may be `JSONFragment`s.  If it is a
+            string, the string itself is assumed to be a JSON string and is
+            returned directly.
         """
-        if not isinstance(json_data,(str,unicode)):
+        if isinstance(json_data, dict) and \
+                any(isinstance(v, JSONFragment) for v in json_data.values()):
+            rest = dict((k, v) for k, v in json_data.items()
+                    if not isinstance(v, JSONFragment))
+            fragments = ['%s: %s' % (simplejson.dumps(k), v.encoded)
+                    for k, v in json_data.items() if isinstance(v, JSONFragment)]
+            if rest:
+                fragments.insert(0, simplejson.dumps(rest)[1:-1])
+            json_data = '{%s}' % ', '.join(fragments)
+        elif not isinstance(json_data,(str,unicode)):
             json_data = simplejson.dumps(json_data)
         return webapp2.Response(json_data, content_type='application/json', charset='utf-8')
 
     def render_csv(self, text):
-        """ Renders text """
-        return webapp2.Response(text, content_type='text/csv', charset='utf-8')
+        """ Renders text, or an iterable of encoded chunks, see `render_stream`.
+        """
+        if isinstance(text, basestring):
+            return webapp2.Response(text, content_type='text/csv', charset='utf-8')
+        return self.render_stream(text, 'text/csv')
+
+    def render_stream(self, chunks, content_type):
+        """ Renders an iterable of utf-8 encoded chunks as the response body,
+        without joining them first.
+        """
+        return webapp2.Response(app_iter=chunks, content_type=content_type, charset='utf-8')
 
 
     def render(self, template,  request, context=None):
@@ -219,17 +273,14 @@ class Webapp(webapp2.WSGIApplication):
         if not context:
             context = {}
         user  = users.get_current_user()
-        context['user'] = None
-        context['user_data'] = {}
-        if user:
-            context['user'] = user
-            user_data = memcache.get('%s-user_data' % (str(user.user_id())))
-            if user_data:
-                context['user_data'] = user_data
+        context['user'] = user
+        # looked up only if the template calls them
+        context['user_data'] = lambda: (user and
+                memcache.get('%s-user_data' % (str(user.user_id())))) or {}
         context['request'] = request.uri
-        context['login_url'] = users.create_login_url("/_post_login/?next=%s"
-                % (request.url))
-        context['logout_url'] = users.create_logout_url("/account/logout/")
+        context['login_url'] = lambda: users.create_login_url(
+                "/_post_login/?next=%s" % (request.url))
+        context['logout_url'] = lambda: users.create_logout_url("/account/logout/")
         context['messages'] = self.get_messages() 
         rv = self.jinja2.render_template(template, **context)
         return rv